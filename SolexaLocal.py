@@ -1,6 +1,7 @@
 import os
 from telegram import Update
 from telegram.ext import Application, MessageHandler, filters, ContextTypes
+from bot_transport import build_requests, transport_stats
 
 # Enable detailed logging
 import logging
@@ -11,6 +12,7 @@ logger = logging.getLogger(__name__)
 
 # Read the bot token from the environment variable
 TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
+TRANSPORT_LOG_INTERVAL = int(os.getenv('TRANSPORT_LOG_INTERVAL', '300'))  # seconds between connection pool stat lines
 
 # Define the keywords and corresponding media files
 keyword_responses = {
@@ -53,8 +55,13 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # Main function to start the bot
 async def main():
     try:
-        # Create the Application and pass it your bot's token
-        application = Application.builder().token(TOKEN).build()
+        # Create the Application with separate tuned connection pools for replies and for polling
+        bot_request, get_updates_request = build_requests()
+        application = (
+            Application.builder().token(TOKEN)
+            .request(bot_request).get_updates_request(get_updates_request)
+            .build()
+        )
 
         # Add a message handler to respond to text messages
         application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
@@ -67,9 +74,11 @@ async def main():
         logger.info("Bot is running...")
         print("Bot is running...")
 
-        # Keep the bot running until manually stopped
+        # Keep the bot running until manually stopped, logging connection pool usage now and then
         while True:
-            await asyncio.sleep(1)
+            await asyncio.sleep(TRANSPORT_LOG_INTERVAL)
+            for pool, stats in transport_stats.items():
+                logger.info(f"Transport {pool}: {stats}")
 
     except Exception as e:
         logger.error(f"Error starting bot: {e}")
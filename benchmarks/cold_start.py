@@ -0,0 +1,115 @@
+"""Measure the cold-start path: module import cost (-X importtime) and startup() phases up to
+webhook registration, against the local stand-in Bot API.
+
+    python benchmarks/cold_start.py [--runs 5] [--top 15]
+"""
+import argparse
+import asyncio
+import os
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from fake_bot_api import FakeBotAPI, free_port, start_server, stop_server
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SOURCE = os.path.join(REPO, "solexacloud.py")
+# Heavy packages from requirements.txt that the bot itself never uses; any that show up are reported with their importer
+HEAVY_OPTIONAL = ("moviepy", "numpy", "imageio", "imageio_ffmpeg", "telethon", "tornado", "apscheduler")
+IMPORT_LINE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+def bot_env(api_port):
+    env = dict(os.environ)
+    env.setdefault("TELEGRAM_BOT_TOKEN", "123456:COLDSTART")
+    env.setdefault("RENDER_EXTERNAL_URL", "http://127.0.0.1")
+    env["TELEGRAM_API_URL"] = f"http://127.0.0.1:{api_port}"
+    env["STATE_DB_FILE"] = os.path.join(tempfile.mkdtemp(prefix="solexa-cold-"), "state.db")
+    env.setdefault("LOG_LEVEL", "WARNING")
+    return env
+
+def profile_import(env):
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import solexacloud"],
+        cwd=REPO, env=env, capture_output=True, text=True
+    )
+    modules = []
+    for line in result.stderr.splitlines():
+        match = IMPORT_LINE.match(line)
+        if match:
+            self_us, cumulative_us, indent, name = match.groups()
+            modules.append((name, int(self_us), int(cumulative_us), len(indent) // 2))
+    return modules
+
+def importer_of(modules, index):
+    # -X importtime lists a module before the module that imported it, one indent level shallower
+    depth = modules[index][3]
+    return next((name for name, _, _, other in modules[index + 1:] if other < depth), None)
+
+def compile_ms():
+    # Run as `python solexacloud.py` the module is __main__, which is never cached as a .pyc
+    with open(SOURCE) as f:
+        source = f.read()
+    started = time.perf_counter()
+    compile(source, SOURCE, "exec")
+    return (time.perf_counter() - started) * 1000
+
+async def measure_startup(api_port):
+    import solexacloud
+    api = FakeBotAPI()
+    server = await start_server(api.app, api_port)
+    try:
+        started = time.perf_counter()
+        await solexacloud.startup()
+        wall_ms = (time.perf_counter() - started) * 1000
+        timings = dict(solexacloud.startup_timings)
+        await solexacloud.shutdown()
+    finally:
+        await stop_server(*server)
+    return wall_ms, timings, [method for _, method, _ in api.calls]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5, help="import profiles to take the median of")
+    parser.add_argument("--top", type=int, default=15, help="modules to list by cumulative time")
+    args = parser.parse_args()
+
+    api_port = free_port()
+    env = bot_env(api_port)
+    profiles = [profile_import(env) for _ in range(args.runs)]
+    totals = [next(cumulative for name, _, cumulative, _ in modules if name == "solexacloud") for modules in profiles]
+    last = profiles[-1]
+    print(f"import solexacloud: median {statistics.median(totals) / 1000:.1f} ms over {args.runs} runs "
+          f"(min {min(totals) / 1000:.1f}, max {max(totals) / 1000:.1f})")
+    print(f"compiling solexacloud.py as __main__: {compile_ms():.1f} ms")
+    print("\ndirect imports of solexacloud by cumulative time (last run):")
+    top_level = [(name, cumulative) for name, _, cumulative, depth in last if depth == 1]
+    for name, cumulative in sorted(top_level, key=lambda item: -item[1])[:args.top]:
+        print(f"  {cumulative / 1000:8.1f} ms  {name}")
+    print("\nslowest modules by self time (last run):")
+    for name, self_us, _, _ in sorted(last, key=lambda item: -item[1])[:args.top]:
+        print(f"  {self_us / 1000:8.1f} ms  {name}")
+    heavy = {}
+    for index, (name, _, cumulative, _) in enumerate(last):
+        package = name.split(".")[0]
+        importer = importer_of(last, index) or ""
+        if package in HEAVY_OPTIONAL and importer.split(".")[0] != package:
+            # Entry points into the package from outside it; their cumulative times do not overlap
+            importers, total = heavy.get(package, ([], 0))
+            heavy[package] = (importers + [importer], total + cumulative)
+    print("\nheavy optional packages imported:" + ("" if heavy else " none"))
+    for package, (importers, cumulative) in heavy.items():
+        print(f"  {package:<14} {cumulative / 1000:8.1f} ms  via {', '.join(sorted(set(importers)))}")
+
+    os.environ.update(env)
+    sys.path.insert(0, REPO)
+    wall_ms, timings, calls = asyncio.run(measure_startup(api_port))
+    print(f"\nstartup() to webhook registered: {wall_ms:.1f} ms")
+    for phase, ms in timings.items():
+        print(f"  {phase:<14} {ms:8.1f} ms")
+    print(f"  Bot API calls: {', '.join(calls)}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""Local stand-in for the Telegram Bot API, shared by the load test and the replay tool.
+
+Point solexacloud at it with TELEGRAM_API_URL=http://127.0.0.1:<port> before importing it.
+"""
+import asyncio
+import json
+import random
+import socket
+import time
+from collections import Counter
+from urllib.parse import parse_qsl
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+ADMIN_RIGHTS = (
+    "can_be_edited", "is_anonymous", "can_manage_chat", "can_delete_messages", "can_manage_video_chats",
+    "can_restrict_members", "can_promote_members", "can_change_info", "can_invite_users",
+    "can_post_stories", "can_edit_stories", "can_delete_stories",
+)
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+class FakeBotAPI:
+    """Answers every Bot API method with a plausible result and records each call."""
+
+    THROTTLED = ("send", "delete", "restrict", "ban", "unban")
+
+    def __init__(self, latency=0.0, rate_limit_ratio=0.0, admin_ids=(1,)):
+        self.latency = latency
+        self.rate_limit_ratio = rate_limit_ratio
+        self.admin_ids = list(admin_ids)
+        self.calls = []  # (monotonic time, method, params)
+        self.rate_limited = Counter()
+        self.next_message_id = 1000
+        self.app = FastAPI()
+        self.app.post("/bot{token}/{method}")(self.handle)
+
+    async def handle(self, token: str, method: str, request: Request):
+        params = {}
+        if request.headers.get("content-type", "").startswith("application/x-www-form-urlencoded"):
+            # Plain calls arrive form-encoded with JSON values; uploads (multipart) are recorded without params
+            for key, value in parse_qsl((await request.body()).decode()):
+                try:
+                    params[key] = json.loads(value)
+                except ValueError:
+                    params[key] = value
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if method.startswith(self.THROTTLED) and random.random() < self.rate_limit_ratio:
+            self.rate_limited[method] += 1
+            return JSONResponse(
+                {"ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1", "parameters": {"retry_after": 1}},
+                status_code=429
+            )
+        self.calls.append((time.monotonic(), method, params))
+        return {"ok": True, "result": self.result(method, params)}
+
+    def result(self, method, params):
+        if method == "getMe":
+            return {"id": 999, "is_bot": True, "first_name": "Solexa", "username": "solexa_load_bot"}
+        if method == "getChatAdministrators":
+            admins = []
+            for index, user_id in enumerate(self.admin_ids):
+                user = {"id": user_id, "is_bot": False, "first_name": f"admin{user_id}"}
+                if index == 0:
+                    admins.append({"status": "creator", "is_anonymous": False, "user": user})
+                else:
+                    admins.append(dict({right: right != "is_anonymous" for right in ADMIN_RIGHTS}, status="administrator", user=user))
+            return admins
+        if method.startswith("send"):
+            self.next_message_id += 1
+            return {
+                "message_id": self.next_message_id, "date": int(time.time()),
+                "chat": {"id": params.get("chat_id"), "type": "supergroup"}, "text": params.get("text", "")
+            }
+        return True
+
+async def start_server(app, port):
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning", log_config=None))
+    task = asyncio.create_task(server.serve())
+    while not server.started:
+        if task.done():
+            raise SystemExit(f"server on port {port} failed to start")
+        await asyncio.sleep(0.01)
+    return server, task
+
+async def stop_server(server, task):
+    server.should_exit = True
+    await task
@@ -0,0 +1,228 @@
+"""Offline load test: boot solexacloud's FastAPI app against a local stand-in Bot API and
+replay synthetic update streams at its /telegram webhook.
+
+    python benchmarks/load_test.py [--scenario text_burst join_raid ...] [--updates 400]
+                                   [--api-latency-ms 20] [--rate-limit-ratio 0.01] [--json]
+
+Scenarios run in order against the same bot process (captcha_callbacks answers the
+captchas join_raid left pending). For each one the report shows throughput, webhook ack
+latency, end-to-end latency from POST to the Bot API call the update should cause, and
+the API calls the bot made.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+
+from fake_bot_api import FakeBotAPI, free_port, start_server, stop_server
+
+ADMIN_ID = 1
+GROUP_ID = -1001000000000
+SCENARIOS = ("text_burst", "join_raid", "captcha_callbacks", "broadcast")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scenario", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument("--updates", type=int, default=400, help="updates per scenario")
+    parser.add_argument("--chats", type=int, default=40, help="chats the text burst is spread over")
+    parser.add_argument("--concurrency", type=int, default=50, help="webhook POSTs in flight")
+    parser.add_argument("--api-latency-ms", type=float, default=20.0, help="stand-in Bot API response delay")
+    parser.add_argument("--rate-limit-ratio", type=float, default=0.0, help="share of send/delete/restrict calls answered with 429")
+    parser.add_argument("--timeout", type=float, default=60.0, help="seconds to wait for a scenario's API calls")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    return parser.parse_args()
+
+args = parse_args()
+API_PORT = free_port()
+BOT_PORT = free_port()
+STATE_DIR = tempfile.mkdtemp(prefix="solexa-load-")
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:LOADTEST")
+os.environ["RENDER_EXTERNAL_URL"] = f"http://127.0.0.1:{BOT_PORT}"
+os.environ["TELEGRAM_API_URL"] = f"http://127.0.0.1:{API_PORT}"
+os.environ["STATE_DB_FILE"] = os.path.join(STATE_DIR, "state.db")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httpx  # noqa: E402
+
+import solexacloud  # noqa: E402
+
+class UpdateFactory:
+    def __init__(self):
+        self.update_id = 0
+        self.message_id = 0
+
+    def message(self, chat_id, user_id, **fields):
+        self.update_id += 1
+        self.message_id += 1
+        message = {
+            "message_id": self.message_id, "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "supergroup", "title": f"Load {chat_id}"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}", "username": f"user{user_id}"},
+        }
+        message.update(fields)
+        return {"update_id": self.update_id, "message": message}
+
+    def command(self, chat_id, user_id, text):
+        command = text.split()[0]
+        return self.message(chat_id, user_id, text=text, entities=[{"type": "bot_command", "offset": 0, "length": len(command)}])
+
+    def callback(self, chat_id, user_id, prompt_id, data):
+        self.update_id += 1
+        return {"update_id": self.update_id, "callback_query": {
+            "id": str(self.update_id), "chat_instance": "load", "data": data,
+            "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"},
+            "message": {"message_id": prompt_id, "date": int(time.time()), "chat": {"id": chat_id, "type": "supergroup"}},
+        }}
+
+# Each scenario returns [(update, [(api_method, param, value)])]: the calls the update must cause.
+
+def text_burst(factory, count, chats):
+    chat_ids = [GROUP_ID - 1 - index for index in range(chats)]
+    for chat_id in chat_ids:
+        solexacloud.filters_dict.setdefault(chat_id, {})["gm"] = "*GM* everyone, welcome to _Solexa_!"
+        solexacloud.index_filter(chat_id, "gm")
+    return [
+        (factory.message(chat_ids[index % chats], 10 + index, text="gm"), [("sendMessage", "chat_id", chat_ids[index % chats])])
+        for index in range(count)
+    ]
+
+def join_raid(factory, count, chats):
+    chat_id = GROUP_ID
+    solexacloud.captcha_enabled[chat_id] = True
+    updates = []
+    for index in range(count):
+        user_id = 100000 + index
+        member = {"id": user_id, "is_bot": False, "first_name": f"joiner{index}", "username": f"joiner{index}"}
+        updates.append((factory.message(chat_id, user_id, new_chat_members=[member]), [("restrictChatMember", "user_id", user_id)]))
+    return updates
+
+def captcha_callbacks(factory, count, chats):
+    updates = []
+    for entry in list(solexacloud.captcha_store.entries.values())[:count]:
+        if entry.prompt_id is None:
+            continue
+        data = f"captcha_0_{entry.answer}" if entry.batch else f"captcha_{entry.user_id}_{entry.answer}"
+        updates.append((factory.callback(entry.chat_id, entry.user_id, entry.prompt_id, data), [("restrictChatMember", "user_id", entry.user_id)]))
+    return updates
+
+def broadcast(factory, count, chats):
+    targets = [GROUP_ID - 5000 - index for index in range(20)]
+    text = "/solexabroadcast " + " ".join(str(target) for target in targets) + " Load test announcement"
+    # The per-chat send buckets allow a handful of broadcasts per minute, so keep the count small
+    return [
+        (factory.command(GROUP_ID, ADMIN_ID, text), [("sendMessage", "chat_id", target) for target in targets])
+        for _ in range(max(1, min(count, solexacloud.CHAT_SEND_BURST)))
+    ]
+
+def percentiles(samples):
+    if not samples:
+        return {"p50": None, "p95": None, "p99": None}
+    ordered = sorted(samples)
+    pick = lambda q: round(ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000, 2)
+    return {"p50": pick(0.5), "p95": pick(0.95), "p99": pick(0.99)}
+
+def match_calls(calls, posted):
+    # For each expectation take the earliest unused matching call made after the POST
+    index = defaultdict(list)
+    for at, method, params in calls:
+        for param in ("chat_id", "user_id"):
+            if param in params:
+                index[(method, param, str(params[param]))].append(at)
+    latencies, unmatched = [], 0
+    for sent_at, expected in posted:
+        finished = None
+        for method, param, value in expected:
+            times = index.get((method, param, str(value)), [])
+            position = next((i for i, at in enumerate(times) if at >= sent_at), None)
+            if position is None:
+                unmatched += 1
+                finished = None
+                break
+            at = times.pop(position)
+            finished = at if finished is None else max(finished, at)
+        if finished is not None:
+            latencies.append(finished - sent_at)
+    return latencies, unmatched
+
+async def run_scenario(name, client, api, factory):
+    updates = globals()[name](factory, args.updates, args.chats)
+    expected = Counter((method, param, str(value)) for _, calls in updates for method, param, value in calls)
+    first_call = len(api.calls)
+    limited_before = sum(api.rate_limited.values())
+    semaphore = asyncio.Semaphore(args.concurrency)
+    posted, acks, statuses = [], [], Counter()
+
+    async def post(update, calls):
+        async with semaphore:
+            sent_at = time.monotonic()
+            response = await client.post("/telegram", json=update)
+            acks.append(time.monotonic() - sent_at)
+            statuses[response.status_code] += 1
+            posted.append((sent_at, calls))
+
+    started = time.monotonic()
+    await asyncio.gather(*(post(update, calls) for update, calls in updates))
+    deadline = time.monotonic() + args.timeout
+    while time.monotonic() < deadline:
+        seen = Counter()
+        for _, method, params in api.calls[first_call:]:
+            for param in ("chat_id", "user_id"):
+                if param in params:
+                    seen[(method, param, str(params[param]))] += 1
+        # Batched raid prompts are still pending until their flush task finishes; a flush leaves
+        # raid_flush_tasks when its window closes, before it has restricted members and sent the prompt
+        flushing = any(task.get_coro().__name__ == "flush_raid_batch" for task in asyncio.all_tasks())
+        if all(seen[key] >= needed for key, needed in expected.items()) and not flushing:
+            break
+        await asyncio.sleep(0.05)
+    calls = api.calls[first_call:]
+    latencies, unmatched = match_calls(calls, posted)
+    finished = max((at for at, _, _ in calls), default=time.monotonic())
+    elapsed = max(finished - started, 1e-9)
+    return {
+        "scenario": name,
+        "updates": len(updates),
+        "statuses": dict(statuses),
+        "seconds": round(elapsed, 3),
+        "updates_per_second": round(len(updates) / elapsed, 1),
+        "ack_ms": percentiles(acks),
+        "end_to_end_ms": percentiles(latencies),
+        "unmatched": unmatched,
+        "api_calls": dict(Counter(method for _, method, _ in calls)),
+        "rate_limited": sum(api.rate_limited.values()) - limited_before,
+    }
+
+def print_report(results):
+    for result in results:
+        print(f"\n== {result['scenario']}: {result['updates']} updates in {result['seconds']}s ({result['updates_per_second']}/s)")
+        print(f"   webhook status {result['statuses']}, unmatched {result['unmatched']}, injected 429s {result['rate_limited']}")
+        for label in ("ack_ms", "end_to_end_ms"):
+            values = result[label]
+            print(f"   {label:<14} p50 {values['p50']}  p95 {values['p95']}  p99 {values['p99']}")
+        print("   api calls      " + ", ".join(f"{method}={count}" for method, count in sorted(result["api_calls"].items())))
+
+async def main():
+    api = FakeBotAPI(args.api_latency_ms / 1000, args.rate_limit_ratio, admin_ids=[ADMIN_ID])
+    api_server = await start_server(api.app, API_PORT)
+    bot_server = await start_server(solexacloud.app, BOT_PORT)
+    results = []
+    factory = UpdateFactory()
+    try:
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{BOT_PORT}", timeout=30) as client:
+            for name in args.scenario:
+                results.append(await run_scenario(name, client, api, factory))
+    finally:
+        await stop_server(*bot_server)
+        await stop_server(*api_server)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_report(results)
+
+if __name__ == "__main__":
+    asyncio.run(main())
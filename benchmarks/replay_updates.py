@@ -0,0 +1,154 @@
+"""Replay recorded updates (see UPDATE_RECORD_DIR in solexacloud.py) through
+application.process_update against the local stand-in Bot API, and report per-handler timings.
+
+    python benchmarks/replay_updates.py /data/recordings/updates-*.jsonl.gz [--speed 1|4|max]
+                                        [--api-latency-ms 20] [--seed 1] [--json]
+
+Updates keep their recorded spacing divided by --speed ("max" sends them back to back).
+State starts empty unless --state-db points at a snapshot of the production database.
+Like the webhook workers, updates from one chat are processed in order and chats run
+concurrently. The random seed is fixed so captcha questions come out the same every run.
+"""
+import argparse
+import asyncio
+import gzip
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from collections import Counter
+
+from fake_bot_api import FakeBotAPI, free_port, start_server, stop_server
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("recordings", nargs="+", help="updates-*.jsonl.gz files, replayed in name order")
+    parser.add_argument("--speed", default="1", help="replay speed multiplier, or max")
+    parser.add_argument("--api-latency-ms", type=float, default=20.0, help="stand-in Bot API response delay")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--state-db", help="copy of a state database to start from (filters, welcomes, captcha settings)")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    return parser.parse_args()
+
+args = parse_args()
+API_PORT = free_port()
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:REPLAY")
+os.environ.setdefault("RENDER_EXTERNAL_URL", "http://127.0.0.1")
+os.environ["TELEGRAM_API_URL"] = f"http://127.0.0.1:{API_PORT}"
+os.environ["STATE_DB_FILE"] = os.path.join(tempfile.mkdtemp(prefix="solexa-replay-"), "state.db")
+if args.state_db:
+    # Work on a copy so the replay never writes into the snapshot
+    shutil.copyfile(args.state_db, os.environ["STATE_DB_FILE"])
+os.environ["UPDATE_RECORD_DIR"] = ""
+os.environ["METRICS_ENABLED"] = "1"
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telegram import Update  # noqa: E402
+
+import solexacloud  # noqa: E402
+
+def read_recordings(paths):
+    records = []
+    for path in sorted(paths):
+        before = len(records)
+        try:
+            with gzip.open(path, "rt", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        continue  # torn last line
+        except (EOFError, gzip.BadGzipFile) as e:
+            # The recorder only closes a file on rotation or clean shutdown, so the current file and
+            # any left by a killed process have no gzip trailer; keep the lines read so far
+            print(f"{path}: {e}; keeping the {len(records) - before} updates read before it", file=sys.stderr)
+    return records
+
+def command_senders(records):
+    # Whoever issued commands in the recording is treated as an admin by the stand-in API
+    senders = set()
+    for record in records:
+        message = record["update"].get("message") or {}
+        if (message.get("text") or "").startswith("/") and message.get("from"):
+            senders.add(message["from"]["id"])
+    return sorted(senders) or [1]
+
+def percentiles(samples):
+    if not samples:
+        return {"p50": None, "p95": None, "p99": None}
+    ordered = sorted(samples)
+    pick = lambda q: round(ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000, 2)
+    return {"p50": pick(0.5), "p95": pick(0.95), "p99": pick(0.99)}
+
+async def replay(records, speed):
+    application = solexacloud.application
+    chains = {}
+    lags = []
+
+    async def process(previous, update, due):
+        if previous is not None:
+            await previous
+        lags.append(time.monotonic() - due)
+        await application.process_update(update)
+
+    base = records[0]["t"]
+    started = time.monotonic()
+    for record in records:
+        due = started if speed is None else started + (record["t"] - base) / speed
+        delay = due - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        chat_id = solexacloud.update_chat_id(record["update"])
+        update = Update.de_json(record["update"], application.bot)
+        chains[chat_id] = asyncio.create_task(process(chains.get(chat_id), update, due))
+    await asyncio.gather(*chains.values())
+    return time.monotonic() - started, lags
+
+async def main():
+    records = read_recordings(args.recordings)
+    if not records:
+        raise SystemExit("no updates in the given recordings")
+    speed = None if args.speed == "max" else float(args.speed)
+    random.seed(args.seed)
+    api = FakeBotAPI(args.api_latency_ms / 1000, admin_ids=command_senders(records))
+    api_server = await start_server(api.app, API_PORT)
+    try:
+        await solexacloud.startup()
+        elapsed, lags = await replay(records, speed)
+        await solexacloud.shutdown()
+    finally:
+        await stop_server(*api_server)
+    report = {
+        "updates": len(records),
+        "recorded_seconds": round(records[-1]["t"] - records[0]["t"], 3),
+        "replay_seconds": round(elapsed, 3),
+        "updates_per_second": round(len(records) / max(elapsed, 1e-9), 1),
+        "start_lag_ms": percentiles(lags),
+        "handlers": {
+            name: {
+                "calls": metric.count, "errors": metric.errors,
+                "mean_ms": round(metric.total / metric.count * 1000, 2),
+                **{f"p{int(q * 100)}_ms": round(metric.quantile(q) * 1000, 2) for q in (0.5, 0.95, 0.99)},
+            }
+            for name, metric in sorted(solexacloud.handler_metrics.items()) if metric.count
+        },
+        "api_calls": dict(Counter(method for _, method, _ in api.calls)),
+    }
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    print(f"{report['updates']} updates ({report['recorded_seconds']}s recorded) replayed in "
+          f"{report['replay_seconds']}s, {report['updates_per_second']}/s")
+    lag = report["start_lag_ms"]
+    print(f"start lag ms  p50 {lag['p50']}  p95 {lag['p95']}  p99 {lag['p99']}")
+    print(f"{'handler':<32}{'calls':>7}{'errors':>8}{'mean':>9}{'p50':>9}{'p95':>9}{'p99':>9}")
+    for name, row in report["handlers"].items():
+        print(f"{name:<32}{row['calls']:>7}{row['errors']:>8}{row['mean_ms']:>9}{row['p50_ms']:>9}{row['p95_ms']:>9}{row['p99_ms']:>9}")
+    print("api calls  " + ", ".join(f"{method}={count}" for method, count in sorted(report["api_calls"].items())))
+
+if __name__ == "__main__":
+    asyncio.run(main())
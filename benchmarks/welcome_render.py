@@ -0,0 +1,100 @@
+"""Compare the per-send cost of welcome rendering: the legacy replace + process_markdown_v2
+path against a precompiled WelcomeTemplate.
+
+    python benchmarks/welcome_render.py [iterations]
+"""
+import os
+import sys
+import timeit
+
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:BENCHMARK")
+os.environ.setdefault("RENDER_EXTERNAL_URL", "http://localhost")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from solexacloud import compile_welcome_template  # noqa: E402
+
+WELCOME_TEXT = (
+    "*Welcome to SOLEXA, {username}!* 🚀\n"
+    "Please read the [rules](https://t.me/solexa/rules) before posting.\n"
+    "_Verified members get access to #trusted._ Have fun, {username} 🎉"
+)
+USERNAMES = ["alice", "bob_the_builder", "Zoë", "moon😀boy", "x" * 32]
+
+def legacy_process_markdown_v2(text):
+    # The renderer as it was before the template work, kept verbatim as the baseline
+    if not text:
+        return ""
+    special_chars = '_*[]()~`>#+-=|{}.!'
+    processed = text.replace('\\', '\\\\')
+    i = 0
+    result = ""
+    in_bold = False
+    in_italic = False
+    in_link_text = False
+    in_link_url = False
+    while i < len(processed):
+        char = processed[i]
+        next_char = processed[i + 1] if i + 1 < len(processed) else None
+        if char == '*' and not in_link_text and not in_link_url:
+            result += '*'
+            in_bold = not in_bold
+            i += 1
+            continue
+        elif char == '_' and not in_link_text and not in_link_url:
+            result += '_'
+            in_italic = not in_italic
+            i += 1
+            continue
+        elif char == '[' and not in_bold and not in_italic and not in_link_text and not in_link_url:
+            result += '['
+            in_link_text = True
+            i += 1
+            continue
+        elif char == ']' and in_link_text:
+            result += ']'
+            in_link_text = False
+            if next_char == '(':
+                result += '('
+                in_link_url = True
+                i += 2
+                continue
+            else:
+                i += 1
+                continue
+        elif char == ')' and in_link_url:
+            result += ')'
+            in_link_url = False
+            i += 1
+            continue
+        else:
+            is_in_formatting = in_bold or in_italic or in_link_text or in_link_url
+            if char in special_chars and not is_in_formatting:
+                result += '\\' + char
+            else:
+                result += char
+            i += 1
+    return result
+
+def legacy_send_path():
+    for username in USERNAMES:
+        legacy_process_markdown_v2(WELCOME_TEXT.replace("{username}", username))
+
+template = compile_welcome_template(WELCOME_TEXT)
+
+def template_send_path():
+    for username in USERNAMES:
+        template.render(username)
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    sends = iterations * len(USERNAMES)
+    results = {}
+    for name, func in (("legacy replace+process_markdown_v2", legacy_send_path), ("precompiled WelcomeTemplate", template_send_path)):
+        seconds = min(timeit.repeat(func, number=iterations, repeat=3))
+        results[name] = seconds
+        print(f"{name:40s} {seconds / sends * 1e6:8.2f} us/send")
+    legacy, compiled = results.values()
+    print(f"speedup: {legacy / compiled:.1f}x")
+
+if __name__ == "__main__":
+    main()
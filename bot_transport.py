@@ -0,0 +1,144 @@
+"""Outbound Bot API transport shared by solexacloud.py (webhook) and SolexaLocal.py (polling).
+
+Bot calls and getUpdates get separate connection pools, so a long poll never holds a
+connection that a broadcast or a raid's restrict calls are waiting for. Settings:
+
+    BOT_API_POOL_SIZE            connections for bot calls (default 256, as ApplicationBuilder)
+    BOT_API_UPDATES_POOL_SIZE    connections for getUpdates (default 1)
+    BOT_API_HTTP2                1 to use HTTP/2 (needs python-telegram-bot[http2])
+    BOT_API_KEEPALIVE            seconds an idle connection is kept open (default 30)
+    BOT_API_CONNECT_TIMEOUT / BOT_API_READ_TIMEOUT / BOT_API_WRITE_TIMEOUT / BOT_API_POOL_TIMEOUT
+    BOT_API_MEDIA_WRITE_TIMEOUT  write timeout for uploads (default 60)
+    BOT_API_TIMEOUTS             per-method read timeouts, e.g. "sendVideo=90,answerCallbackQuery=3"
+"""
+import importlib.util
+import logging
+import os
+import time
+
+import httpx
+from telegram.error import TimedOut
+from telegram.request import HTTPXRequest
+
+logger = logging.getLogger(__name__)
+
+BOT_API_POOL_SIZE = int(os.getenv('BOT_API_POOL_SIZE', '256'))
+BOT_API_UPDATES_POOL_SIZE = int(os.getenv('BOT_API_UPDATES_POOL_SIZE', '1'))
+BOT_API_HTTP2 = os.getenv('BOT_API_HTTP2', '0') == '1'
+BOT_API_KEEPALIVE = float(os.getenv('BOT_API_KEEPALIVE', '30'))
+BOT_API_CONNECT_TIMEOUT = float(os.getenv('BOT_API_CONNECT_TIMEOUT', '5'))
+BOT_API_READ_TIMEOUT = float(os.getenv('BOT_API_READ_TIMEOUT', '10'))
+BOT_API_WRITE_TIMEOUT = float(os.getenv('BOT_API_WRITE_TIMEOUT', '10'))
+BOT_API_POOL_TIMEOUT = float(os.getenv('BOT_API_POOL_TIMEOUT', '5'))
+BOT_API_MEDIA_WRITE_TIMEOUT = float(os.getenv('BOT_API_MEDIA_WRITE_TIMEOUT', '60'))
+
+# Read timeouts for methods whose Telegram-side work differs from the default: uploads are
+# processed before Telegram answers, callback answers are useless after a few seconds
+METHOD_READ_TIMEOUTS = {
+    "sendVideo": 60.0,
+    "sendAnimation": 60.0,
+    "sendAudio": 45.0,
+    "sendDocument": 45.0,
+    "sendPhoto": 30.0,
+    "answerCallbackQuery": 3.0,
+}
+for item in filter(None, (part.strip() for part in os.getenv('BOT_API_TIMEOUTS', '').split(","))):
+    name, _, seconds = item.partition("=")
+    try:
+        METHOD_READ_TIMEOUTS[name.strip()] = float(seconds)
+    except ValueError:
+        logger.error(f"Ignoring invalid BOT_API_TIMEOUTS entry: {item}")
+
+def pool_stats():
+    return {
+        "requests": 0,
+        "connections_opened": 0,
+        "connections_reused": 0,
+        "pool_timeouts": 0,
+        "pool_wait_seconds_total": 0.0,
+        "pool_wait_seconds_max": 0.0,
+    }
+
+transport_stats = {"bot": pool_stats(), "get_updates": pool_stats()}
+
+def http_version():
+    if BOT_API_HTTP2 and importlib.util.find_spec("h2") is None:
+        logger.error("BOT_API_HTTP2=1 but the h2 package is missing; falling back to HTTP/1.1")
+        return "1.1"
+    return "2" if BOT_API_HTTP2 else "1.1"
+
+class TunedRequest(HTTPXRequest):
+    """HTTPXRequest with per-method read timeouts that records how long each call waited for
+    a pooled connection and whether it got a reused one.
+
+    httpcore has no trace point for the pool itself, so the wait runs from handing the request
+    to the transport until the first network step: opening a TCP connection (a new one) or
+    sending request headers (a reused one).
+    """
+
+    def __init__(self, pool, pool_size, on_pool_wait=None, **kwargs):
+        self.pool = pool
+        self.stats = transport_stats.setdefault(pool, pool_stats())
+        self.on_pool_wait = on_pool_wait
+        limits = httpx.Limits(
+            max_connections=pool_size,
+            max_keepalive_connections=pool_size,
+            keepalive_expiry=BOT_API_KEEPALIVE,
+        )
+        super().__init__(
+            connection_pool_size=pool_size,
+            http_version=http_version(),
+            httpx_kwargs={"limits": limits, "event_hooks": {"request": [self.trace_request]}},
+            **kwargs,
+        )
+
+    async def trace_request(self, request):
+        queued_at = time.perf_counter()
+        acquired = False
+
+        async def trace(event, info):
+            nonlocal acquired
+            if acquired:
+                return
+            if event == "connection.connect_tcp.started":
+                self.stats["connections_opened"] += 1
+            elif event.endswith(".send_request_headers.started"):
+                self.stats["connections_reused"] += 1
+            else:
+                return
+            acquired = True
+            self.record_pool_wait(time.perf_counter() - queued_at)
+
+        self.stats["requests"] += 1
+        request.extensions["trace"] = trace
+
+    def record_pool_wait(self, seconds):
+        self.stats["pool_wait_seconds_total"] += seconds
+        if seconds > self.stats["pool_wait_seconds_max"]:
+            self.stats["pool_wait_seconds_max"] = seconds
+        if self.on_pool_wait is not None:
+            self.on_pool_wait(self.pool, seconds)
+
+    async def do_request(self, url, method, request_data=None, read_timeout=HTTPXRequest.DEFAULT_NONE, **kwargs):
+        if read_timeout is HTTPXRequest.DEFAULT_NONE:
+            read_timeout = METHOD_READ_TIMEOUTS.get(url.rsplit("/", 1)[-1], read_timeout)
+        try:
+            return await super().do_request(url, method, request_data, read_timeout=read_timeout, **kwargs)
+        except TimedOut as e:
+            if isinstance(e.__cause__, httpx.PoolTimeout):
+                self.stats["pool_timeouts"] += 1
+            raise
+
+def build_requests(request_class=TunedRequest, on_pool_wait=None):
+    """Return (bot request, getUpdates request) for ApplicationBuilder.request/get_updates_request."""
+    timeouts = {
+        "connect_timeout": BOT_API_CONNECT_TIMEOUT,
+        "read_timeout": BOT_API_READ_TIMEOUT,
+        "write_timeout": BOT_API_WRITE_TIMEOUT,
+        "pool_timeout": BOT_API_POOL_TIMEOUT,
+        "media_write_timeout": BOT_API_MEDIA_WRITE_TIMEOUT,
+    }
+    return (
+        request_class("bot", BOT_API_POOL_SIZE, on_pool_wait, **timeouts),
+        request_class("get_updates", BOT_API_UPDATES_POOL_SIZE, on_pool_wait, **timeouts),
+    )
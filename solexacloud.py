@@ -1,32 +1,257 @@
 import os
+import atexit
 import logging
 import json
+import hashlib
+import functools
+import gzip
 import random
 import re
+import time
+import asyncio
+import bisect
+import heapq
+import sqlite3
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from logging.handlers import QueueHandler, QueueListener
+from queue import SimpleQueue
+from collections import OrderedDict, deque
 from datetime import timedelta
 from fastapi import FastAPI, Request
-import uvicorn
+try:
+    import orjson  # optional; parses webhook bodies several times faster than json
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+from fastapi.responses import JSONResponse, PlainTextResponse
 from telegram import (
-    Update, ChatPermissions, InlineKeyboardButton, InlineKeyboardMarkup, User, MessageEntity
+    Update, ChatPermissions, InlineKeyboardButton, InlineKeyboardMarkup, User, MessageEntity, InputFile
 )
 from telegram.ext import (
-    Application, MessageHandler, filters, ContextTypes, CallbackQueryHandler, CommandHandler
-)
-from telegram.error import BadRequest, Forbidden
-
-logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
+    Application, MessageHandler, filters, ContextTypes, CallbackQueryHandler, CommandHandler, ChatMemberHandler
 )
+from telegram.constants import ChatMemberStatus
+from telegram.error import BadRequest, Forbidden, RetryAfter, TimedOut, NetworkError
+from bot_transport import TunedRequest, build_requests, transport_stats
+
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_LEVELS = os.getenv('LOG_LEVELS', 'httpx=WARNING')  # e.g. "updates=DEBUG,state=WARNING,httpx=WARNING"
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text').lower()  # "text" or "json" (JSON lines)
+LOG_STATE_MAX_CHARS = int(os.getenv('LOG_STATE_MAX_CHARS', '500'))
+UPDATE_LOG_SAMPLE_RATE = float(os.getenv('UPDATE_LOG_SAMPLE_RATE', '0'))
+
+class LogSnippet:
+    """Defers repr() until a record is actually emitted and caps its length."""
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        text = self.value if isinstance(self.value, str) else repr(self.value)
+        if len(text) > LOG_STATE_MAX_CHARS:
+            return f"{text[:LOG_STATE_MAX_CHARS]}... ({len(text)} chars)"
+        return text
+
+class LazyJSON:
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return json.dumps(self.value, separators=(",", ":"), ensure_ascii=False)
+
+class JSONLinesFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+class DeferredQueueHandler(QueueHandler):
+    """Resolves the message on the caller's thread; timestamps, formatting and I/O happen in the listener thread."""
+
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+LOG_CATEGORIES = ("updates", "state", "messages")
+log_queue = SimpleQueue()
+log_listener = None
+
+def setup_logging():
+    global log_listener
+    stream_handler = logging.StreamHandler()
+    if LOG_FORMAT == "json":
+        stream_handler.setFormatter(JSONLinesFormatter())
+    else:
+        stream_handler.setFormatter(logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s"))
+    log_listener = QueueListener(log_queue, stream_handler)
+    log_listener.start()
+    atexit.register(stop_logging)
+    root = logging.getLogger()
+    root.handlers[:] = [DeferredQueueHandler(log_queue)]
+    root.setLevel(LOG_LEVEL)
+    for item in filter(None, (part.strip() for part in LOG_LEVELS.split(","))):
+        name, _, level = item.partition("=")
+        name = name.strip()
+        # Bare category names ("updates", "state", "messages") refer to this module's child loggers
+        target = logging.getLogger(f"{__name__}.{name}" if name in LOG_CATEGORIES else name)
+        target.setLevel(level.strip().upper())
+
+def stop_logging():
+    global log_listener
+    if log_listener is not None:
+        log_listener.stop()
+        log_listener = None
+
+setup_logging()
 logger = logging.getLogger(__name__)
+update_logger = logger.getChild("updates")
+state_logger = logger.getChild("state")
+message_logger = logger.getChild("messages")
 
 TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
 WEBHOOK_URL = os.getenv('RENDER_EXTERNAL_URL') + "/telegram"
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL', 'https://api.telegram.org')  # a local Bot API server or the load-test stand-in
+
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', '1') == '1'
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class LatencyMetric:
+    """Fixed-bucket latency histogram with error and in-flight counts for one handler or API method."""
+    __slots__ = ("buckets", "count", "total", "errors", "in_flight")
+
+    def __init__(self):
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)  # last slot is +Inf
+        self.count = 0
+        self.total = 0.0
+        self.errors = 0
+        self.in_flight = 0
+
+    def observe(self, seconds):
+        self.buckets[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+
+    def quantile(self, q):
+        # Linear interpolation inside the bucket holding the q-th observation
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for index, hits in enumerate(self.buckets):
+            if hits and seen + hits >= rank:
+                lower = LATENCY_BUCKETS[index - 1] if index else 0.0
+                upper = LATENCY_BUCKETS[index] if index < len(LATENCY_BUCKETS) else LATENCY_BUCKETS[-1]
+                return lower + (upper - lower) * (rank - seen) / hits
+            seen += hits
+        return LATENCY_BUCKETS[-1]
+
+handler_metrics = {}  # handler callback name -> LatencyMetric
+api_metrics = {}  # Bot API method -> LatencyMetric
+pool_wait_metrics = {}  # connection pool name -> LatencyMetric of time spent waiting for a connection
+
+def instrument_handler(callback):
+    metric = handler_metrics.setdefault(callback.__name__, LatencyMetric())
+
+    @functools.wraps(callback)
+    async def instrumented(update, context):
+        metric.in_flight += 1
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except Exception:
+            metric.errors += 1
+            raise
+        finally:
+            metric.in_flight -= 1
+            metric.observe(time.perf_counter() - started)
+    return instrumented
+
+def instrument_handlers(application):
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            handler.callback = instrument_handler(handler.callback)
+
+def observe_pool_wait(pool, seconds):
+    metric = pool_wait_metrics.get(pool)
+    if metric is None:
+        metric = pool_wait_metrics[pool] = LatencyMetric()
+    metric.observe(seconds)
+
+class InstrumentedRequest(TunedRequest):
+    """TunedRequest that times every Bot API call, labeled by method name."""
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        api_method = url.rsplit("/", 1)[-1]
+        metric = api_metrics.get(api_method)
+        if metric is None:
+            metric = api_metrics[api_method] = LatencyMetric()
+        metric.in_flight += 1
+        started = time.perf_counter()
+        try:
+            code, payload = await super().do_request(url, method, request_data, **kwargs)
+        except Exception:
+            metric.errors += 1
+            raise
+        finally:
+            metric.in_flight -= 1
+            metric.observe(time.perf_counter() - started)
+        if code >= 400:
+            metric.errors += 1
+        return code, payload
+
+def prometheus_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def render_latency_metrics(name, label, metrics):
+    lines = [f"# TYPE {name}_seconds histogram"]
+    for key, metric in metrics.items():
+        labels = f'{label}="{prometheus_label(key)}"'
+        cumulative = 0
+        for bound, hits in zip(LATENCY_BUCKETS, metric.buckets):
+            cumulative += hits
+            lines.append(f'{name}_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_seconds_bucket{{{labels},le="+Inf"}} {metric.count}')
+        lines.append(f"{name}_seconds_sum{{{labels}}} {metric.total}")
+        lines.append(f"{name}_seconds_count{{{labels}}} {metric.count}")
+    lines.append(f"# TYPE {name}_quantile_seconds gauge")
+    for key, metric in metrics.items():
+        for q in (0.5, 0.95, 0.99):
+            lines.append(f'{name}_quantile_seconds{{{label}="{prometheus_label(key)}",quantile="{q}"}} {metric.quantile(q):.6f}')
+    lines.append(f"# TYPE {name}_errors_total counter")
+    lines.extend(f'{name}_errors_total{{{label}="{prometheus_label(key)}"}} {metric.errors}' for key, metric in metrics.items())
+    lines.append(f"# TYPE {name}_in_flight gauge")
+    lines.extend(f'{name}_in_flight{{{label}="{prometheus_label(key)}"}} {metric.in_flight}' for key, metric in metrics.items())
+    return lines
 
-captcha_attempts = {}
 app = FastAPI()
-application = Application.builder().token(TOKEN).build()
+bot_request, get_updates_request = (
+    build_requests(InstrumentedRequest, observe_pool_wait) if METRICS_ENABLED else build_requests()
+)
+application = (
+    # Deletions have their own scheduler, so the APScheduler-backed job queue is never started
+    Application.builder().token(TOKEN).job_queue(None)
+    .base_url(f"{TELEGRAM_API_URL}/bot").base_file_url(f"{TELEGRAM_API_URL}/file/bot")
+    .request(bot_request).get_updates_request(get_updates_request)
+    .build()
+)
 
-user_id_cache = {}
 CAPTCHA_STATE_FILE = "/data/captcha_state.json"
 captcha_enabled = {}
 WELCOME_STATE_FILE = "/data/welcome_state.json"
@@ -42,6 +267,44 @@ welcome_auto_delete = {}
 CHAT_IDS_FILE = "/data/chat_ids.json"
 chat_ids_map = {}
 
+ADMIN_CACHE_TTL = int(os.getenv('ADMIN_CACHE_TTL', '300'))
+ADMIN_CACHE_MAX_CHATS = int(os.getenv('ADMIN_CACHE_MAX_CHATS', '500'))
+admin_cache = OrderedDict()  # chat_id -> (expires_at, frozenset of admin user IDs), LRU order
+admin_cache_pending = {}  # chat_id -> in-flight getChatAdministrators task
+admin_cache_generation = {}  # chat_id -> bumped on every invalidation, so fetches started before it are not cached
+admin_cache_stats = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+
+UPDATE_WORKERS = int(os.getenv('UPDATE_WORKERS', '8'))
+UPDATE_QUEUE_SIZE = int(os.getenv('UPDATE_QUEUE_SIZE', '1000'))
+UPDATE_ENQUEUE_TIMEOUT = float(os.getenv('UPDATE_ENQUEUE_TIMEOUT', '2'))
+UPDATE_DRAIN_TIMEOUT = float(os.getenv('UPDATE_DRAIN_TIMEOUT', '25'))
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+update_queues = []  # one bounded queue per worker; a chat always maps to the same queue
+update_workers = []
+accepting_updates = False
+update_queue_stats = {"enqueued": 0, "processed": 0, "failed": 0, "rejected": 0, "duplicates": 0, "max_depth": 0, "total_wait_ms": 0.0, "max_wait_ms": 0.0}
+UPDATE_DEDUP_WINDOW = int(os.getenv('UPDATE_DEDUP_WINDOW', '10000'))
+
+BOT_SEND_RATE = float(os.getenv('BOT_SEND_RATE', '30'))  # messages/second across all chats
+CHAT_SEND_RATE = float(os.getenv('CHAT_SEND_RATE', str(20 / 60)))  # messages/second to one group
+CHAT_SEND_BURST = int(os.getenv('CHAT_SEND_BURST', '3'))
+BROADCAST_MAX_ATTEMPTS = int(os.getenv('BROADCAST_MAX_ATTEMPTS', '4'))
+CHAT_SEND_BUCKETS_MAX = int(os.getenv('CHAT_SEND_BUCKETS_MAX', '1000'))
+chat_send_buckets = OrderedDict()  # chat_id -> TokenBucket, LRU order
+
+RAID_JOIN_THRESHOLD = int(os.getenv('RAID_JOIN_THRESHOLD', '10'))  # joins within RAID_WINDOW that start raid mode
+RAID_WINDOW = float(os.getenv('RAID_WINDOW', '10'))
+RAID_COOLDOWN = float(os.getenv('RAID_COOLDOWN', '60'))  # raid mode lingers this long after the last burst
+RAID_BATCH_WINDOW = float(os.getenv('RAID_BATCH_WINDOW', '3'))
+RAID_MAX_NAMES = int(os.getenv('RAID_MAX_NAMES', '20'))
+join_history = {}  # chat_id -> deque of recent join times, at most RAID_JOIN_THRESHOLD long
+raid_until = {}  # chat_id -> monotonic time raid mode stays active until
+raid_joins = {}  # chat_id -> [(user_id, username, restrict task)] waiting for the next batched captcha prompt
+raid_welcomes = {}  # chat_id -> usernames waiting for the next batched welcome
+raid_flush_tasks = {}
+captcha_batches = {}  # (chat_id, prompt message_id) -> user IDs still expected to answer it
+raid_stats = {"raids": 0, "batched_members": 0, "batches": 0, "batched_welcomes": 0}
+
 keyword_responses = {
     "PutMP3TriggerKeywordHere": "PUTmp3FILEnameHere.mp3",
     "PutVideoTriggerKeywordHere": "PutMp4FileNameHere.mp4",
@@ -50,102 +313,622 @@ keyword_responses = {
     "launch cat": "launchcat.gif"
 }
 
+MEDIA_KINDS = {".mp3": "audio", ".mp4": "video", ".jpg": "photo", ".gif": "animation"}
+media_file_ids = {}  # path -> {"kind", "size", "mtime", "sha256", "file_id"} for uploaded keyword media
+media_cache_stats = {"hits": 0, "uploads": 0, "invalidations": 0, "rejected": 0}
+ASSET_PRELOAD_MAX_BYTES = int(os.getenv('ASSET_PRELOAD_MAX_BYTES', str(5 * 1024 * 1024)))
+ASSET_PRELOAD_BUDGET_BYTES = int(os.getenv('ASSET_PRELOAD_BUDGET_BYTES', str(50 * 1024 * 1024)))
+asset_registry = {}  # path -> {"kind", "size", "mtime", "sha256", "data": bytes or None}, built at startup
+
 FILTERS_FILE = "/data/filters.json"
 filters_dict = {}
+filter_index = {}  # chat_id -> {"keyword" and "/keyword": keyword}
+filter_automata = {}  # chat_id -> KeywordAutomaton, built lazily for "contains" chats
+filter_templates = {}  # chat_id -> {keyword: MarkdownV2 rendering of the response text}
+welcome_templates = {}  # chat_id -> WelcomeTemplate of the welcome text
+FILTER_MODE_FILE = "/data/filter_mode.json"
+filter_match_mode = {}  # chat_id -> "exact" | "contains"
+
+STATE_BACKEND = os.getenv('STATE_BACKEND', 'sqlite').lower()
+STATE_DB_FILE = os.getenv('STATE_DB_FILE', '/data/solexa_state.db')
+LEGACY_STATE_FILES = {
+    "filters": FILTERS_FILE,
+    "filter_mode": FILTER_MODE_FILE,
+    "captcha_state": CAPTCHA_STATE_FILE,
+    "welcome_state": WELCOME_STATE_FILE,
+    "cleansystem_state": CLEANSYSTEM_STATE_FILE,
+    "autodelete_config": AUTODELETE_CONFIG_FILE,
+    "welcome_autodelete_state": WELCOME_AUTODELETE_STATE_FILE,
+    "chat_ids": CHAT_IDS_FILE,
+}
+# A single worker keeps writes ordered and owns the SQLite connection
+state_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="state-io")
+state_backend = None
+STATE_FLUSH_DELAY = int(os.getenv('STATE_FLUSH_DELAY_MS', '500')) / 1000
+dirty_state = {}  # namespace -> {"mapping", "encode", "keys": dirty keys, "replace": rewrite whole namespace}
+state_flush_handle = None
+STATE_FLUSH_MAX_BACKOFF = float(os.getenv('STATE_FLUSH_MAX_BACKOFF', '30'))
+state_flush_backoff = 0.0  # delay before retrying a failed flush, doubled on each consecutive failure
+state_flush_stats = {"marked": 0, "coalesced": 0, "flushes": 0, "failures": 0, "last_flush_ms": 0.0, "max_flush_ms": 0.0, "total_flush_ms": 0.0}
+
+def read_legacy_file(path):
+    # None when the file does not exist; read and parse errors propagate
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        data = json.load(f)
+    if not isinstance(data, dict):
+        raise ValueError(f"expected a JSON object, got {type(data).__name__}")
+    return data
+
+def read_legacy_json(path):
+    try:
+        return read_legacy_file(path) or {}
+    except Exception as e:
+        logger.error(f"Error reading legacy state file {path}: {e}")
+    return {}
+
+def atomic_write_text(path, text):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+class SQLiteStateBackend:
+    """Key/value state in one SQLite table, one row per (namespace, key), values JSON-encoded."""
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = None
+
+    def connect(self):
+        if self.conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS state ("
+                "namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, "
+                "PRIMARY KEY (namespace, key))"
+            )
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS deletions ("
+                "chat_id INTEGER NOT NULL, message_id INTEGER NOT NULL, due REAL NOT NULL, "
+                "PRIMARY KEY (chat_id, message_id))"
+            )
+            conn.commit()
+            self.conn = conn
+            self.import_legacy_json()
+        return self.conn
+
+    def import_legacy_json(self):
+        if self.conn.execute("SELECT 1 FROM meta WHERE key = 'legacy_json_imported'").fetchone():
+            return  # every file was imported in one go by an earlier version
+        imported = {row[0] for row in self.conn.execute("SELECT key FROM meta WHERE key LIKE 'legacy_imported:%'")}
+        for namespace, path in LEGACY_STATE_FILES.items():
+            if f"legacy_imported:{namespace}" in imported:
+                continue
+            try:
+                data = read_legacy_file(path)
+            except Exception as e:
+                # Left unmarked so the import is retried on the next start instead of losing the file's data
+                logger.error(f"Error reading legacy state file {path}, not importing it: {e}")
+                continue
+            with self.conn:
+                if data is not None:
+                    # OR IGNORE: on a retry, entries written since the first start win over the old file
+                    self.conn.executemany(
+                        "INSERT OR IGNORE INTO state (namespace, key, value) VALUES (?, ?, ?)",
+                        [(namespace, str(key), json.dumps(value)) for key, value in data.items()]
+                    )
+                    state_logger.info("Imported %d %s entries from %s", len(data), namespace, path)
+                    self.mark_initialized(namespace)
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (f"legacy_imported:{namespace}", str(time.time()))
+                )
+
+    def mark_initialized(self, namespace):
+        self.conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES (?, ?)", (f"initialized:{namespace}", str(time.time())))
+
+    def initialized(self, namespace):
+        # Whether the namespace was ever written, even if every key has since been deleted
+        conn = self.connect()
+        if conn.execute("SELECT 1 FROM meta WHERE key = ?", (f"initialized:{namespace}",)).fetchone():
+            return True
+        return conn.execute("SELECT 1 FROM state WHERE namespace = ? LIMIT 1", (namespace,)).fetchone() is not None
+
+    def load(self, namespace):
+        rows = self.connect().execute("SELECT key, value FROM state WHERE namespace = ?", (namespace,))
+        return dict(rows.fetchall())
+
+    def write_batch(self, batches):
+        conn = self.connect()
+        with conn:
+            for namespace, upserts, deletes, replace in batches:
+                if replace:
+                    conn.execute("DELETE FROM state WHERE namespace = ?", (namespace,))
+                if deletes:
+                    conn.executemany("DELETE FROM state WHERE namespace = ? AND key = ?", [(namespace, key) for key in deletes])
+                if upserts:
+                    conn.executemany(
+                        "INSERT INTO state (namespace, key, value) VALUES (?, ?, ?) "
+                        "ON CONFLICT (namespace, key) DO UPDATE SET value = excluded.value",
+                        [(namespace, key, value) for key, value in upserts.items()]
+                    )
+                    self.mark_initialized(namespace)
+
+    def load_deletions(self):
+        return self.connect().execute("SELECT chat_id, message_id, due FROM deletions").fetchall()
+
+    def write_deletions(self, adds, removes):
+        conn = self.connect()
+        with conn:
+            if removes:
+                conn.executemany("DELETE FROM deletions WHERE chat_id = ? AND message_id = ?", removes)
+            if adds:
+                conn.executemany("INSERT OR REPLACE INTO deletions (chat_id, message_id, due) VALUES (?, ?, ?)", adds)
+
+    def compact_deletions(self, live, cutoff):
+        conn = self.connect()
+        with conn:
+            dropped = conn.execute("DELETE FROM deletions WHERE due < ?", (cutoff,)).rowcount
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        return dropped
+
+class JSONStateBackend:
+    """Legacy layout: one JSON file per namespace, rewritten atomically on every change."""
+
+    def __init__(self, files):
+        self.files = files
+        self.cache = {}  # namespace -> {key: encoded value}
+        self.deletions_log = os.path.join(os.path.dirname(STATE_DB_FILE), "deletions.log")
+
+    def path(self, namespace):
+        # Namespaces added after the legacy layout get their own file next to the others
+        return self.files.get(namespace) or os.path.join(os.path.dirname(STATE_DB_FILE), f"{namespace}.json")
+
+    def initialized(self, namespace):
+        return os.path.exists(self.path(namespace))
+
+    def load(self, namespace):
+        data = {str(key): json.dumps(value) for key, value in read_legacy_json(self.path(namespace)).items()}
+        self.cache[namespace] = data
+        return dict(data)
+
+    def write_batch(self, batches):
+        for namespace, upserts, deletes, replace in batches:
+            if replace or namespace not in self.cache:
+                data = {} if replace else self.load(namespace)
+                self.cache[namespace] = data
+            data = self.cache[namespace]
+            for key in deletes:
+                data.pop(key, None)
+            data.update(upserts)
+            body = ", ".join(f"{json.dumps(key)}: {value}" for key, value in data.items())
+            atomic_write_text(self.path(namespace), "{" + body + "}")
+
+    def load_deletions(self):
+        # Append-only log: [chat_id, message_id, due] schedules, [chat_id, message_id] cancels
+        live = {}
+        try:
+            if os.path.exists(self.deletions_log):
+                with open(self.deletions_log, 'r') as f:
+                    for line in f:
+                        try:
+                            record = json.loads(line)
+                        except ValueError:
+                            continue  # torn final line from a crash
+                        if len(record) == 3:
+                            live[(record[0], record[1])] = record[2]
+                        else:
+                            live.pop((record[0], record[1]), None)
+        except Exception as e:
+            logger.error(f"Error reading deletion log {self.deletions_log}: {e}")
+        return [(chat_id, message_id, due) for (chat_id, message_id), due in live.items()]
+
+    def write_deletions(self, adds, removes):
+        with open(self.deletions_log, 'a') as f:
+            for chat_id, message_id in removes:
+                f.write(f"[{chat_id}, {message_id}]\n")
+            for chat_id, message_id, due in adds:
+                f.write(f"[{chat_id}, {message_id}, {due}]\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def compact_deletions(self, live, cutoff):
+        kept = [row for row in live if row[2] >= cutoff]
+        atomic_write_text(self.deletions_log, "".join(f"[{chat_id}, {message_id}, {due}]\n" for chat_id, message_id, due in kept))
+        return len(live) - len(kept)
+
+def open_state_backend():
+    global state_backend
+    if state_backend is None:
+        if STATE_BACKEND == "json":
+            state_backend = JSONStateBackend(LEGACY_STATE_FILES)
+        else:
+            try:
+                backend = SQLiteStateBackend(STATE_DB_FILE)
+                backend.connect()
+                state_backend = backend
+            except Exception as e:
+                logger.error(f"Error opening state database {STATE_DB_FILE}, falling back to JSON files: {e}")
+                state_backend = JSONStateBackend(LEGACY_STATE_FILES)
+        state_logger.info("State backend: %s", type(state_backend).__name__)
+    return state_backend
+
+def state_load(namespace):
+    def load():
+        return {key: json.loads(value) for key, value in open_state_backend().load(namespace).items()}
+    return state_executor.submit(load).result()
+
+def state_initialized(namespace):
+    return state_executor.submit(lambda: open_state_backend().initialized(namespace)).result()
+
+def persist_state(namespace, mapping, key=None, encode=lambda value: value):
+    # Write-behind: only mark the key dirty; repeated marks within STATE_FLUSH_DELAY coalesce
+    entry = dirty_state.get(namespace)
+    if entry is None:
+        entry = {"mapping": mapping, "encode": encode, "keys": set(), "replace": False}
+        dirty_state[namespace] = entry
+    entry["mapping"] = mapping
+    state_flush_stats["marked"] += 1
+    if entry["replace"] or key in entry["keys"]:
+        state_flush_stats["coalesced"] += 1
+    if key is None:
+        entry["replace"] = True
+        entry["keys"].clear()
+    elif not entry["replace"]:
+        entry["keys"].add(key)
+    schedule_state_flush()
+
+def schedule_state_flush(delay=None):
+    global state_flush_handle
+    if state_flush_handle is not None:
+        return
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        state_executor.submit(write_state_batches, collect_dirty_state())
+        return
+    state_flush_handle = loop.call_later(STATE_FLUSH_DELAY if delay is None else delay, lambda: asyncio.ensure_future(flush_dirty_state()))
+
+def collect_dirty_state():
+    # Encode on the event loop so the worker never sees live, still-mutating state
+    batches = []
+    for namespace, entry in dirty_state.items():
+        mapping, encode = entry["mapping"], entry["encode"]
+        keys = mapping.keys() if entry["replace"] else entry["keys"]
+        upserts = {str(key): json.dumps(encode(mapping[key])) for key in keys if key in mapping}
+        deletes = [str(key) for key in keys if key not in mapping]
+        batches.append((namespace, upserts, deletes, entry["replace"]))
+    dirty_state.clear()
+    return batches
+
+def requeue_dirty_state(entries):
+    # Merge a failed flush's entries back; mappings are live, so the retry encodes current values
+    for namespace, entry in entries.items():
+        current = dirty_state.get(namespace)
+        if current is None:
+            dirty_state[namespace] = entry
+        elif entry["replace"]:
+            current["replace"] = True
+            current["keys"].clear()
+        elif not current["replace"]:
+            current["keys"].update(entry["keys"])
+
+def write_state_batches(batches):
+    if not batches:
+        return
+    started = time.perf_counter()
+    try:
+        open_state_backend().write_batch(batches)
+    except Exception as e:
+        state_flush_stats["failures"] += 1
+        logger.error(f"Error writing state for {', '.join(batch[0] for batch in batches)}: {e}")
+        return False
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    state_flush_stats["flushes"] += 1
+    state_flush_stats["last_flush_ms"] = elapsed_ms
+    state_flush_stats["max_flush_ms"] = max(state_flush_stats["max_flush_ms"], elapsed_ms)
+    state_flush_stats["total_flush_ms"] += elapsed_ms
+    state_logger.debug("State flushed: %s in %.1fms", [batch[0] for batch in batches], elapsed_ms)
+    return True
+
+async def flush_dirty_state():
+    global state_flush_handle, state_flush_backoff
+    if state_flush_handle is not None:
+        state_flush_handle.cancel()
+        state_flush_handle = None
+    entries = dict(dirty_state)
+    batches = collect_dirty_state()
+    if not batches:
+        return
+    if await asyncio.get_running_loop().run_in_executor(state_executor, write_state_batches, batches) is False:
+        requeue_dirty_state(entries)
+        state_flush_backoff = min(max(STATE_FLUSH_DELAY, state_flush_backoff * 2), STATE_FLUSH_MAX_BACKOFF)
+        state_logger.warning("State flush failed, retrying in %.1fs", state_flush_backoff)
+        schedule_state_flush(state_flush_backoff)
+    else:
+        state_flush_backoff = 0.0
+
+def flush_state_writes():
+    state_executor.submit(lambda: None).result()
 
 def load_filters():
     global filters_dict
     try:
-        if os.path.exists(FILTERS_FILE):
-            with open(FILTERS_FILE, 'r') as f:
-                data = json.load(f)
-                filters_dict = {int(chat_id): filters for chat_id, filters in data.items()}
-        else:
-            filters_dict = {}
-        logger.info(f"Filters loaded: {repr(filters_dict)}")
+        data = state_load("filters")
+        filters_dict = {int(chat_id): filters for chat_id, filters in data.items()}
+        state_logger.info("Filters loaded: %s", LogSnippet(filters_dict))
     except Exception as e:
         logger.error(f"Error loading filters: {e}")
         filters_dict = {}
+    filter_index.clear()
+    filter_automata.clear()
+    for chat_id in filters_dict:
+        rebuild_filter_index(chat_id)
 
-def save_filters():
+def save_filters(chat_id=None):
     try:
-        with open(FILTERS_FILE, 'w') as f:
-            json.dump({str(chat_id): filters for chat_id, filters in filters_dict.items()}, f)
-        logger.info(f"Filters saved: {repr(filters_dict)}")
+        persist_state("filters", filters_dict, chat_id)
+        state_logger.debug("Filters saved: %s", LogSnippet(filters_dict))
     except Exception as e:
         logger.error(f"Error saving filters: {e}")
 
+def rebuild_filter_index(chat_id):
+    index = {}
+    for keyword in filters_dict.get(chat_id, {}):
+        index.setdefault(f"/{keyword}", keyword)
+    for keyword in filters_dict.get(chat_id, {}):
+        index[keyword] = keyword
+    filter_index[chat_id] = index
+    filter_automata.pop(chat_id, None)
+    filter_templates[chat_id] = {keyword: render_filter_text(response) for keyword, response in filters_dict.get(chat_id, {}).items()}
+
+def index_filter(chat_id, keyword):
+    index = filter_index.setdefault(chat_id, {})
+    index[keyword] = keyword
+    index.setdefault(f"/{keyword}", keyword)
+    filter_automata.pop(chat_id, None)
+    filter_templates.setdefault(chat_id, {})[keyword] = render_filter_text(filters_dict[chat_id][keyword])
+
+def render_filter_text(response):
+    text = response.get('text', '') if isinstance(response, dict) else response
+    formatted_text = render_markdown_v2(text)
+    markdown_parse_mode(text, formatted_text)  # validate now so sends never learn by failing
+    return formatted_text
+
+def filter_format_note(chat_id, keyword):
+    response = filters_dict[chat_id][keyword]
+    text = response.get('text', '') if isinstance(response, dict) else response
+    if text and markdown_parse_mode(text, filter_templates[chat_id][keyword]) == "plain":
+        return " (formatting is invalid, it will be sent as plain text)"
+    return ""
+
+def unindex_filter(chat_id, keyword):
+    # A removed keyword may have shadowed another's "/" alias, so rebuild the chat's index
+    rebuild_filter_index(chat_id)
+
+def find_filter(chat_id, message_text, commands_only=False):
+    index = filter_index.get(chat_id)
+    if not index:
+        return None
+    keyword = index.get(message_text)
+    if keyword is not None and commands_only and message_text != f"/{keyword}":
+        keyword = None
+    if keyword is None and not commands_only and filter_match_mode.get(chat_id) == "contains":
+        automaton = filter_automata.get(chat_id)
+        if automaton is None:
+            automaton = KeywordAutomaton(filters_dict.get(chat_id, {}).keys())
+            filter_automata[chat_id] = automaton
+        keyword = automaton.find_first(message_text)
+    return keyword
+
+class KeywordAutomaton:
+    """Aho-Corasick matcher reporting the leftmost-longest keyword contained in a text."""
+
+    def __init__(self, keywords):
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [None]  # longest keyword ending at this state, via fail links
+        self.max_length = 0
+        for keyword in keywords:
+            if not keyword:
+                continue
+            self.max_length = max(self.max_length, len(keyword))
+            state = 0
+            for char in keyword:
+                next_state = self.goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self.goto)
+                    self.goto[state][char] = next_state
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append(None)
+                state = next_state
+            self.output[state] = keyword
+        queue = list(self.goto[0].values())
+        for state in queue:
+            for char, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[next_state] = self.goto[fallback].get(char, 0)
+                if self.output[next_state] is None:
+                    self.output[next_state] = self.output[self.fail[next_state]]
+
+    def find_first(self, text):
+        best = None
+        best_start = 0
+        state = 0
+        for position, char in enumerate(text):
+            while state and char not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(char, 0)
+            keyword = self.output[state]
+            if keyword is not None:
+                start = position - len(keyword) + 1
+                if best is None or start < best_start or (start == best_start and len(keyword) > len(best)):
+                    best, best_start = keyword, start
+            if best is not None and position - self.max_length + 2 > best_start:
+                break  # no later match can start at or before the current best
+        return best
+
+def load_filter_mode():
+    global filter_match_mode
+    try:
+        data = state_load("filter_mode")
+        filter_match_mode = {int(chat_id): mode for chat_id, mode in data.items()}
+        state_logger.info("Filter match mode loaded: %s", LogSnippet(filter_match_mode))
+    except Exception as e:
+        logger.error(f"Error loading filter match mode: {e}")
+        filter_match_mode = {}
+
+def save_filter_mode(chat_id=None):
+    try:
+        persist_state("filter_mode", filter_match_mode, chat_id)
+        state_logger.debug("Filter match mode saved: %s", LogSnippet(filter_match_mode))
+    except Exception as e:
+        logger.error(f"Error saving filter match mode: {e}")
+
 def load_captcha_state():
     global captcha_enabled
     try:
-        if os.path.exists(CAPTCHA_STATE_FILE):
-            with open(CAPTCHA_STATE_FILE, 'r') as f:
-                data = json.load(f)
-                captcha_enabled = {int(chat_id): bool(state) for chat_id, state in data.items()}
-        else:
-            captcha_enabled = {}
-        logger.info(f"Captcha state loaded: {repr(captcha_enabled)}")
+        data = state_load("captcha_state")
+        captcha_enabled = {int(chat_id): bool(state) for chat_id, state in data.items()}
+        state_logger.info("Captcha state loaded: %s", LogSnippet(captcha_enabled))
     except Exception as e:
         logger.error(f"Error loading captcha state: {e}")
         captcha_enabled = {}
 
-def save_captcha_state():
+def save_captcha_state(chat_id=None):
     try:
-        with open(CAPTCHA_STATE_FILE, 'w') as f:
-            json.dump({str(chat_id): state for chat_id, state in captcha_enabled.items()}, f)
-        logger.info(f"Captcha state saved: {repr(captcha_enabled)}")
+        persist_state("captcha_state", captcha_enabled, chat_id)
+        state_logger.debug("Captcha state saved: %s", LogSnippet(captcha_enabled))
     except Exception as e:
         logger.error(f"Error saving captcha state: {e}")
 
 def load_welcome_state():
     global welcome_state
     try:
-        if os.path.exists(WELCOME_STATE_FILE):
-            with open(WELCOME_STATE_FILE, 'r') as f:
-                data = json.load(f)
-                welcome_state = {int(chat_id): v for chat_id, v in data.items()}
-                for chat_id, state in welcome_state.items():
-                    if "entities" in state and isinstance(state["entities"], list):
-                        welcome_state[chat_id]["entities"] = [MessageEntity(**entity) for entity in state["entities"]]
-        else:
-            welcome_state = {}
-        logger.info(f"Welcome state loaded: {repr(welcome_state)}")
+        data = state_load("welcome_state")
+        welcome_state = {int(chat_id): v for chat_id, v in data.items()}
+        for chat_id, state in welcome_state.items():
+            if "entities" in state and isinstance(state["entities"], list):
+                welcome_state[chat_id]["entities"] = [MessageEntity(**entity) for entity in state["entities"]]
+            refresh_welcome_template(chat_id)
+        state_logger.info("Welcome state loaded: %s", LogSnippet(welcome_state))
     except Exception as e:
         logger.error(f"Error loading welcome state: {e}")
         welcome_state = {}
 
-def save_welcome_state():
+def serialize_welcome_config(state):
+    serialized = state.copy()
+    if serialized.get("entities"):
+        serialized["entities"] = [entity.to_dict() for entity in state["entities"]]
+    return serialized
+
+def refresh_welcome_template(chat_id):
+    text = welcome_state.get(chat_id, {}).get("text")
+    if not text:
+        welcome_templates.pop(chat_id, None)
+    elif chat_id not in welcome_templates or welcome_templates[chat_id].source != text:
+        welcome_templates[chat_id] = compile_welcome_template(text)
+        welcome_parse_mode(welcome_templates[chat_id])
+
+def welcome_format_note(chat_id):
+    template = welcome_templates.get(chat_id)
+    if template is not None and welcome_parse_mode(template) == "plain":
+        return f" (formatting is invalid: {welcome_template_error(template)}; it will be sent as plain text)"
+    return ""
+
+def save_welcome_state(chat_id=None):
+    for key in (welcome_state if chat_id is None else [chat_id]):
+        refresh_welcome_template(key)
     try:
-        serialized_state = {}
-        for chat_id, state in welcome_state.items():
-            serialized_state[str(chat_id)] = state.copy()
-            if "entities" in serialized_state[str(chat_id)] and serialized_state[str(chat_id)]["entities"]:
-                serialized_state[str(chat_id)]["entities"] = [entity.to_dict() for entity in state["entities"]]
-        with open(WELCOME_STATE_FILE, 'w') as f:
-            json.dump(serialized_state, f)
-        logger.info(f"Welcome state saved: {repr(welcome_state)}")
+        persist_state("welcome_state", welcome_state, chat_id, serialize_welcome_config)
+        state_logger.debug("Welcome state saved: %s", LogSnippet(welcome_state))
     except Exception as e:
         logger.error(f"Error saving welcome state: {e}")
 
+WELCOME_TRACK_MAX = int(os.getenv('WELCOME_TRACK_MAX', '20'))  # sent welcomes remembered per chat for cleanup
+welcome_messages = {}  # chat_id -> deque of (message_id, sent_at) for welcomes still in the chat
+welcome_lifecycle_stats = {"retired": 0, "expired": 0, "evicted": 0}
+
+def track_welcome(chat_id, message_id):
+    tracked = welcome_messages.get(chat_id)
+    if tracked is None:
+        tracked = welcome_messages[chat_id] = deque(maxlen=WELCOME_TRACK_MAX)
+    prune_welcomes(chat_id)
+    if len(tracked) == tracked.maxlen:
+        welcome_lifecycle_stats["evicted"] += 1
+    tracked.append((message_id, time.time()))
+    save_welcome_messages(chat_id)
+
+def prune_welcomes(chat_id):
+    # Past the 48 hour window deleteMessages can no longer remove them, so stop tracking
+    tracked = welcome_messages.get(chat_id)
+    cutoff = time.time() - DELETE_MAX_AGE
+    while tracked and tracked[0][1] < cutoff:
+        tracked.popleft()
+        welcome_lifecycle_stats["expired"] += 1
+
+def retire_welcomes(chat_id):
+    """Hand every tracked welcome in the chat to the deletion scheduler and forget it."""
+    prune_welcomes(chat_id)
+    tracked = welcome_messages.pop(chat_id, None)
+    if not tracked:
+        return 0
+    for message_id, _ in tracked:
+        schedule_deletion(chat_id, message_id, 0)
+    welcome_lifecycle_stats["retired"] += len(tracked)
+    save_welcome_messages(chat_id)
+    return len(tracked)
+
+def load_welcome_messages():
+    try:
+        data = state_load("welcome_messages")
+        welcome_messages.clear()
+        for chat_id, items in data.items():
+            welcome_messages[int(chat_id)] = deque((tuple(item) for item in items), maxlen=WELCOME_TRACK_MAX)
+        # Older state kept bare message IDs inside welcome_state; their send time is unknown
+        for chat_id, state in welcome_state.items():
+            legacy_ids = state.pop("message_ids", None)
+            if legacy_ids and chat_id not in welcome_messages:
+                now = time.time()
+                welcome_messages[chat_id] = deque(((message_id, now) for message_id in legacy_ids), maxlen=WELCOME_TRACK_MAX)
+                save_welcome_messages(chat_id)
+                save_welcome_state(chat_id)
+        for chat_id in list(welcome_messages):
+            prune_welcomes(chat_id)
+        state_logger.info("Tracked welcome messages loaded: %s", sum(len(tracked) for tracked in welcome_messages.values()))
+    except Exception as e:
+        logger.error(f"Error loading tracked welcome messages: {e}")
+
+def save_welcome_messages(chat_id=None):
+    try:
+        persist_state("welcome_messages", welcome_messages, chat_id, list)
+    except Exception as e:
+        logger.error(f"Error saving tracked welcome messages: {e}")
+
 def load_cleansystem_state():
     global cleansystem_enabled
     try:
-        if os.path.exists(CLEANSYSTEM_STATE_FILE):
-            with open(CLEANSYSTEM_STATE_FILE, 'r') as f:
-                data = json.load(f)
-                cleansystem_enabled = {int(chat_id): bool(state) for chat_id, state in data.items()}
-        else:
-            cleansystem_enabled = {}
-        logger.info(f"Clean system state loaded: {repr(cleansystem_enabled)}")
+        data = state_load("cleansystem_state")
+        cleansystem_enabled = {int(chat_id): bool(state) for chat_id, state in data.items()}
+        state_logger.info("Clean system state loaded: %s", LogSnippet(cleansystem_enabled))
     except Exception as e:
         logger.error(f"Error loading clean system state: {e}")
         cleansystem_enabled = {}
 
-def save_cleansystem_state():
+def save_cleansystem_state(chat_id=None):
     try:
-        with open(CLEANSYSTEM_STATE_FILE, 'w') as f:
-            json.dump({str(chat_id): state for chat_id, state in cleansystem_enabled.items()}, f)
-        logger.info(f"Clean system state saved: {repr(cleansystem_enabled)}")
+        persist_state("cleansystem_state", cleansystem_enabled, chat_id)
+        state_logger.debug("Clean system state saved: %s", LogSnippet(cleansystem_enabled))
     except Exception as e:
         logger.error(f"Error saving clean system state: {e}")
 
@@ -155,256 +938,963 @@ def load_autodelete_config():
         "admin": 30, "error": 15, "captcha": 30, "captcha_prompt": 120, "welcome": 0, "filter": 0, "system": 0
     }
     try:
-        if os.path.exists(AUTODELETE_CONFIG_FILE):
-            with open(AUTODELETE_CONFIG_FILE, 'r') as f:
-                loaded_config = json.load(f)
-                autodelete_config = {**default_config, **loaded_config}
-        else:
-            autodelete_config = default_config.copy()
-        logger.info(f"Auto-delete config loaded: {repr(autodelete_config)}")
+        loaded_config = state_load("autodelete_config")
+        autodelete_config = {**default_config, **loaded_config}
+        state_logger.info("Auto-delete config loaded: %s", LogSnippet(autodelete_config))
     except Exception as e:
         logger.error(f"Error loading auto-delete config: {e}")
         autodelete_config = default_config.copy()
 
-def save_autodelete_config():
+def save_autodelete_config(category=None):
     try:
-        with open(AUTODELETE_CONFIG_FILE, 'w') as f:
-            json.dump(autodelete_config, f)
-        logger.info(f"Auto-delete config saved: {repr(autodelete_config)}")
+        persist_state("autodelete_config", autodelete_config, category)
+        state_logger.debug("Auto-delete config saved: %s", LogSnippet(autodelete_config))
     except Exception as e:
         logger.error(f"Error saving auto-delete config: {e}")
 
 def load_welcome_autodelete_state():
     global welcome_auto_delete
     try:
-        if os.path.exists(WELCOME_AUTODELETE_STATE_FILE):
-            with open(WELCOME_AUTODELETE_STATE_FILE, 'r') as f:
-                data = json.load(f)
-                welcome_auto_delete = {int(chat_id): bool(state) for chat_id, state in data.items()}
-        else:
-            welcome_auto_delete = {}
-        logger.info(f"Welcome auto-delete state loaded: {repr(welcome_auto_delete)}")
+        data = state_load("welcome_autodelete_state")
+        welcome_auto_delete = {int(chat_id): bool(state) for chat_id, state in data.items()}
+        state_logger.info("Welcome auto-delete state loaded: %s", LogSnippet(welcome_auto_delete))
     except Exception as e:
         logger.error(f"Error loading welcome auto-delete state: {e}")
         welcome_auto_delete = {}
 
-def save_welcome_autodelete_state():
+def save_welcome_autodelete_state(chat_id=None):
     try:
-        with open(WELCOME_AUTODELETE_STATE_FILE, 'w') as f:
-            json.dump({str(chat_id): state for chat_id, state in welcome_auto_delete.items()}, f)
-        logger.info(f"Welcome auto-delete state saved: {repr(welcome_auto_delete)}")
+        persist_state("welcome_autodelete_state", welcome_auto_delete, chat_id)
+        state_logger.debug("Welcome auto-delete state saved: %s", LogSnippet(welcome_auto_delete))
     except Exception as e:
         logger.error(f"Error saving welcome auto-delete state: {e}")
 
 def load_chat_ids():
     global chat_ids_map
+    default_chat_ids = {
+        "#solexamain": -1002280396764,
+        "#trusted": -1002213872502,
+        "#bottest": -1002408047628
+    }
     try:
-        if os.path.exists(CHAT_IDS_FILE):
-            with open(CHAT_IDS_FILE, 'r') as f:
-                data = json.load(f)
-                chat_ids_map = {tag: int(chat_id) for tag, chat_id in data.items()}
+        data = state_load("chat_ids")
+        # Seed the default rooms only on first run, not after every room was removed
+        if data or state_initialized("chat_ids"):
+            chat_ids_map = {tag: int(chat_id) for tag, chat_id in data.items()}
         else:
-            chat_ids_map = {
-                "#solexamain": -1002280396764,
-                "#trusted": -1002213872502,
-                "#bottest": -1002408047628
-            }
+            chat_ids_map = default_chat_ids
             save_chat_ids()
-        logger.info(f"Chat IDs loaded: {repr(chat_ids_map)}")
+        state_logger.info("Chat IDs loaded: %s", LogSnippet(chat_ids_map))
     except Exception as e:
         logger.error(f"Error loading chat IDs: {e}")
-        chat_ids_map = {
-            "#solexamain": -1002280396764,
-            "#trusted": -1002213872502,
-            "#bottest": -1002408047628
-        }
+        chat_ids_map = default_chat_ids
         save_chat_ids()
 
-def save_chat_ids():
+def save_chat_ids(tag=None):
     try:
-        with open(CHAT_IDS_FILE, 'w') as f:
-            json.dump(chat_ids_map, f)
-        logger.info(f"Chat IDs saved: {repr(chat_ids_map)}")
+        persist_state("chat_ids", chat_ids_map, tag)
+        state_logger.debug("Chat IDs saved: %s", LogSnippet(chat_ids_map))
     except Exception as e:
         logger.error(f"Error saving chat IDs: {e}")
 
-def escape_markdown_v2(text):
-    if not text:
-        return ""
-    escape_chars = '_*[]()~`>#+-=|{}.!'
-    result = text.replace('\\', '\\\\')
-    for char in escape_chars:
-        result = result.replace(char, f'\\{char}')
-    return result
+CAPTCHA_TIMEOUT = float(os.getenv('CAPTCHA_TIMEOUT', '120'))  # unverified members are removed after this many seconds
+CAPTCHA_SWEEP_INTERVAL = float(os.getenv('CAPTCHA_SWEEP_INTERVAL', '5'))
+captcha_stats = {"issued": 0, "verified": 0, "failed": 0, "expired": 0, "kick_errors": 0}
+
+class CaptchaEntry:
+    __slots__ = ("chat_id", "user_id", "answer", "attempts", "username", "prompt_id", "batch", "deadline")
+
+    def __init__(self, chat_id, user_id, answer, username, deadline, attempts=0, prompt_id=None, batch=False):
+        self.chat_id = chat_id
+        self.user_id = user_id
+        self.answer = answer
+        self.attempts = attempts
+        self.username = username
+        self.prompt_id = prompt_id
+        self.batch = batch
+        self.deadline = deadline  # wall-clock time so deadlines survive a restart
+
+    def to_dict(self):
+        return {
+            "chat_id": self.chat_id, "user_id": self.user_id, "answer": self.answer, "attempts": self.attempts,
+            "username": self.username, "prompt_id": self.prompt_id, "batch": self.batch, "deadline": self.deadline
+        }
+
+class CaptchaStore:
+    """Pending captchas keyed by (chat_id, user_id), expired in deadline order from a heap."""
+
+    def __init__(self):
+        self.entries = {}
+        self.persisted = {}  # "chat_id:user_id" -> entry, the shape the state store keeps
+        self.deadlines = []  # (deadline, chat_id, user_id); stale items are skipped when popped
+
+    @staticmethod
+    def state_key(chat_id, user_id):
+        return f"{chat_id}:{user_id}"
+
+    def add(self, entry):
+        key = (entry.chat_id, entry.user_id)
+        self.entries[key] = entry
+        self.persisted[self.state_key(*key)] = entry
+        heapq.heappush(self.deadlines, (entry.deadline, entry.chat_id, entry.user_id))
+        self.save(*key)
+        return entry
+
+    def get(self, chat_id, user_id):
+        return self.entries.get((chat_id, user_id))
+
+    def pop(self, chat_id, user_id):
+        entry = self.entries.pop((chat_id, user_id), None)
+        if entry is not None:
+            del self.persisted[self.state_key(chat_id, user_id)]
+            self.save(chat_id, user_id)
+        return entry
+
+    def save(self, chat_id, user_id):
+        try:
+            persist_state("captcha_pending", self.persisted, self.state_key(chat_id, user_id), CaptchaEntry.to_dict)
+        except Exception as e:
+            logger.error(f"Error saving pending captcha {chat_id}:{user_id}: {e}")
+
+    def pop_expired(self, now):
+        expired = []
+        while self.deadlines and self.deadlines[0][0] <= now:
+            deadline, chat_id, user_id = heapq.heappop(self.deadlines)
+            entry = self.entries.get((chat_id, user_id))
+            if entry is not None and entry.deadline == deadline:
+                expired.append(self.pop(chat_id, user_id))
+        # Answered captchas leave stale heap items behind; rebuild once they dominate
+        if len(self.deadlines) > 2 * len(self.entries) + 64:
+            self.deadlines = [(entry.deadline, entry.chat_id, entry.user_id) for entry in self.entries.values()]
+            heapq.heapify(self.deadlines)
+        return expired
+
+    def load(self, data):
+        self.entries.clear()
+        self.persisted.clear()
+        for item in data.values():
+            entry = CaptchaEntry(**item)
+            self.entries[(entry.chat_id, entry.user_id)] = entry
+            self.persisted[self.state_key(entry.chat_id, entry.user_id)] = entry
+        self.deadlines = [(entry.deadline, entry.chat_id, entry.user_id) for entry in self.entries.values()]
+        heapq.heapify(self.deadlines)
+
+    def gauges(self):
+        chats = {chat_id for chat_id, _ in self.entries}
+        next_deadline = min((entry.deadline for entry in self.entries.values()), default=None)
+        return {
+            "pending": len(self.entries),
+            "pending_chats": len(chats),
+            "next_expiry_seconds": None if next_deadline is None else max(0.0, next_deadline - time.time()),
+        }
+
+captcha_store = CaptchaStore()
+captcha_expiry_task = None
+
+def load_captcha_pending():
+    try:
+        captcha_store.load(state_load("captcha_pending"))
+        captcha_batches.clear()
+        for entry in captcha_store.entries.values():
+            if entry.batch and entry.prompt_id is not None:
+                captcha_batches.setdefault((entry.chat_id, entry.prompt_id), set()).add(entry.user_id)
+        state_logger.info("Pending captchas loaded: %s", len(captcha_store.entries))
+    except Exception as e:
+        logger.error(f"Error loading pending captchas: {e}")
+        captcha_store.load({})
+
+USER_INDEX_MAX_PER_CHAT = int(os.getenv('USER_INDEX_MAX_PER_CHAT', '5000'))
+USER_INDEX_MAX_ENTRIES = int(os.getenv('USER_INDEX_MAX_ENTRIES', '200000'))  # budget across all chats
+
+class UserIndex:
+    """Username -> user_id per chat, LRU within each chat and bounded globally."""
+
+    def __init__(self, max_per_chat, max_entries):
+        self.max_per_chat = max_per_chat
+        self.max_entries = max_entries
+        self.chats = OrderedDict()  # chat_id -> OrderedDict(username -> user_id), least recently active chat first
+        self.size = 0
+        self.stats = {"hits": 0, "misses": 0, "inserts": 0, "updates": 0, "chat_evictions": 0, "global_evictions": 0}
+
+    def remember(self, chat_id, username, user_id):
+        username = sys.intern(username.lower())
+        users = self.chats.get(chat_id)
+        if users is None:
+            users = self.chats[chat_id] = OrderedDict()
+        else:
+            self.chats.move_to_end(chat_id)
+        previous = users.get(username)
+        if previous is not None:
+            users.move_to_end(username)
+            if previous == user_id:
+                return  # recency only; not worth a write
+            users[username] = user_id
+            self.stats["updates"] += 1
+        else:
+            users[username] = user_id
+            self.size += 1
+            self.stats["inserts"] += 1
+            if len(users) > self.max_per_chat:
+                users.popitem(last=False)
+                self.size -= 1
+                self.stats["chat_evictions"] += 1
+            self.enforce_budget()
+        self.save(chat_id)
+
+    def enforce_budget(self):
+        while self.size > self.max_entries:
+            chat_id, users = next(iter(self.chats.items()))
+            users.popitem(last=False)
+            self.size -= 1
+            self.stats["global_evictions"] += 1
+            if not users:
+                del self.chats[chat_id]
+            self.save(chat_id)
+
+    def lookup(self, chat_id, username):
+        users = self.chats.get(chat_id)
+        user_id = users.get(username.lower()) if users else None
+        if user_id is None:
+            self.stats["misses"] += 1
+            return None
+        self.stats["hits"] += 1
+        users.move_to_end(username.lower())
+        return user_id
 
-def process_markdown_v2(text):
+    def save(self, chat_id):
+        try:
+            persist_state("user_index", self.chats, chat_id, lambda users: list(users.items()))
+        except Exception as e:
+            logger.error(f"Error saving user index for chat {chat_id}: {e}")
+
+    def load(self, data):
+        self.chats.clear()
+        self.size = 0
+        for chat_id, pairs in data.items():
+            users = OrderedDict((sys.intern(username), int(user_id)) for username, user_id in pairs[-self.max_per_chat:])
+            if users:
+                self.chats[int(chat_id)] = users
+                self.size += len(users)
+        evictions = self.stats["global_evictions"]
+        self.enforce_budget()
+        self.stats["global_evictions"] = evictions  # trimming a lowered budget at startup is not churn
+
+    def gauges(self):
+        return {"entries": self.size, "chats": len(self.chats)}
+
+user_id_cache = UserIndex(USER_INDEX_MAX_PER_CHAT, USER_INDEX_MAX_ENTRIES)
+
+def load_user_index():
+    try:
+        user_id_cache.load(state_load("user_index"))
+        state_logger.info("User index loaded: %s usernames in %s chats", user_id_cache.size, len(user_id_cache.chats))
+    except Exception as e:
+        logger.error(f"Error loading user index: {e}")
+        user_id_cache.load({})
+
+DELETE_TICK = float(os.getenv('DELETE_TICK', '1'))  # deletions due within the same tick share a bucket
+DELETE_BATCH_SIZE = 100  # deleteMessages accepts at most 100 IDs per call
+DELETE_MAX_AGE = 47 * 3600  # bots cannot delete messages older than 48 hours
+DELETE_REPLAY_BATCH = int(os.getenv('DELETE_REPLAY_BATCH', '100'))  # overdue deletions released per DELETE_REPLAY_INTERVAL after a restart
+DELETE_REPLAY_INTERVAL = float(os.getenv('DELETE_REPLAY_INTERVAL', '1'))
+DELETE_COMPACT_INTERVAL = float(os.getenv('DELETE_COMPACT_INTERVAL', '3600'))
+
+class DeletionScheduler:
+    """Pending auto-deletions grouped into time buckets and flushed per chat with deleteMessages.
+
+    Every schedule and completion is journaled to the state backend on the next loop
+    iteration, so pending deletions survive a redeploy.
+    """
+
+    def __init__(self, tick):
+        self.tick = tick
+        self.buckets = {}  # tick number -> {chat_id: [message_id]}
+        self.ticks = []  # heap of tick numbers with a bucket
+        self.pending = {}  # chat_id -> {message_id: due}
+        self.size = 0
+        self.wakeup = None  # created by run(); on Python 3.9 an Event binds to the loop current at creation
+        self.journal_adds = []
+        self.journal_removes = []
+        self.journal_scheduled = False
+        self.next_compaction = time.time() + DELETE_COMPACT_INTERVAL
+        self.stats = {
+            "scheduled": 0, "deleted": 0, "api_calls": 0, "errors": 0, "last_lag_ms": 0.0, "max_lag_ms": 0.0,
+            "replayed": 0, "dropped_stale": 0, "compactions": 0
+        }
+
+    def schedule(self, chat_id, message_id, delay, due=None, journal=True):
+        due = time.time() + delay if due is None else due
+        chat_pending = self.pending.setdefault(chat_id, {})
+        if message_id in chat_pending:
+            return
+        chat_pending[message_id] = due
+        self.size += 1
+        tick = int(due // self.tick)
+        bucket = self.buckets.get(tick)
+        if bucket is None:
+            bucket = self.buckets[tick] = {}
+            heapq.heappush(self.ticks, tick)
+            if self.ticks[0] == tick and self.wakeup is not None:
+                self.wakeup.set()
+        bucket.setdefault(chat_id, []).append(message_id)
+        if journal:
+            # Rows replayed from the journal were already counted when first scheduled
+            self.stats["scheduled"] += 1
+            self.journal_adds.append((chat_id, message_id, due))
+            self.schedule_journal()
+
+    def pop_due(self, now):
+        due = {}
+        current = int(now // self.tick)
+        while self.ticks and self.ticks[0] <= current:
+            for chat_id, message_ids in self.buckets.pop(heapq.heappop(self.ticks)).items():
+                due.setdefault(chat_id, []).extend(message_ids)
+        return due
+
+    def next_due_in(self, now):
+        if not self.ticks:
+            return None
+        return max(0.0, (self.ticks[0] + 1) * self.tick - now)
+
+    def forget(self, chat_id, message_ids):
+        chat_pending = self.pending.get(chat_id, {})
+        due = [chat_pending.pop(message_id) for message_id in message_ids if message_id in chat_pending]
+        self.size -= len(due)
+        if not chat_pending:
+            self.pending.pop(chat_id, None)
+        self.journal_removes.extend((chat_id, message_id) for message_id in message_ids)
+        self.schedule_journal()
+        return due
+
+    def schedule_journal(self):
+        if self.journal_scheduled:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.flush_journal()
+            return
+        self.journal_scheduled = True
+        loop.call_soon(self.flush_journal)
+
+    def flush_journal(self):
+        # Everything scheduled or finished during one loop iteration becomes one ordered write
+        self.journal_scheduled = False
+        adds, removes = self.journal_adds, self.journal_removes
+        if not adds and not removes:
+            return
+        self.journal_adds, self.journal_removes = [], []
+        state_executor.submit(write_deletion_journal, adds, removes)
+
+    def replay(self, rows):
+        now = time.time()
+        overdue = []
+        stale = []
+        for chat_id, message_id, due in rows:
+            if due < now - DELETE_MAX_AGE:
+                stale.append((chat_id, message_id))
+            elif due <= now:
+                overdue.append((due, chat_id, message_id))
+            else:
+                self.schedule(chat_id, message_id, 0, due=due, journal=False)
+        # Release the backlog from before the restart gradually instead of in one burst
+        overdue.sort()
+        for index, (_, chat_id, message_id) in enumerate(overdue):
+            delay = (index // max(1, DELETE_REPLAY_BATCH)) * DELETE_REPLAY_INTERVAL
+            self.schedule(chat_id, message_id, delay, journal=False)
+        if stale:
+            self.journal_removes.extend(stale)
+            self.schedule_journal()
+        self.stats["replayed"] += len(overdue)
+        self.stats["dropped_stale"] += len(stale)
+        return len(overdue), len(stale)
+
+    def compact(self):
+        self.next_compaction = time.time() + DELETE_COMPACT_INTERVAL
+        self.flush_journal()
+        live = [(chat_id, message_id, due) for chat_id, chat_pending in self.pending.items() for message_id, due in chat_pending.items()]
+        state_executor.submit(compact_deletion_journal, live, time.time() - DELETE_MAX_AGE)
+        self.stats["compactions"] += 1
+
+    def gauges(self):
+        now = time.time()
+        oldest = min((self.ticks[0] + 1) * self.tick, now) if self.ticks else now
+        return {"pending": self.size, "pending_chats": len(self.pending), "overdue_seconds": now - oldest}
+
+    async def delete_batch(self, bot, chat_id, message_ids):
+        await global_send_bucket.acquire()
+        self.stats["api_calls"] += 1
+        try:
+            if len(message_ids) == 1:
+                await bot.delete_message(chat_id, message_ids[0])
+            else:
+                await bot.delete_messages(chat_id, message_ids)
+            self.stats["deleted"] += len(message_ids)
+            message_logger.info("Deleted %s messages in chat %s", len(message_ids), chat_id)
+        except RetryAfter as e:
+            await asyncio.sleep(retry_after_seconds(e))
+            return False
+        except Exception as e:
+            self.stats["errors"] += 1
+            logger.error(f"Failed to delete messages {message_ids} in chat {chat_id}: {e}")
+        return True
+
+    async def run(self, bot):
+        self.wakeup = asyncio.Event()
+        while True:
+            now = time.time()
+            if now >= self.next_compaction:
+                self.compact()
+            delay = self.next_due_in(now)
+            self.wakeup.clear()
+            if delay is None or delay > 0:
+                timeout = DELETE_COMPACT_INTERVAL if delay is None else min(delay, DELETE_COMPACT_INTERVAL)
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            for chat_id, message_ids in self.pop_due(now).items():
+                for start in range(0, len(message_ids), DELETE_BATCH_SIZE):
+                    chunk = message_ids[start:start + DELETE_BATCH_SIZE]
+                    try:
+                        done = await self.delete_batch(bot, chat_id, chunk)
+                    except Exception as e:
+                        logger.error(f"Error deleting messages in chat {chat_id}: {e}")
+                        done = True
+                    due = self.forget(chat_id, chunk)
+                    if not done:
+                        # Flood control: put the chunk back for the next tick
+                        for message_id in chunk:
+                            self.schedule(chat_id, message_id, self.tick)
+                        continue
+                    if due:
+                        lag_ms = (time.time() - min(due)) * 1000
+                        self.stats["last_lag_ms"] = lag_ms
+                        self.stats["max_lag_ms"] = max(self.stats["max_lag_ms"], lag_ms)
+
+def write_deletion_journal(adds, removes):
+    try:
+        open_state_backend().write_deletions(adds, removes)
+    except Exception as e:
+        logger.error(f"Error journaling {len(adds)} scheduled and {len(removes)} finished deletions: {e}")
+
+def compact_deletion_journal(live, cutoff):
+    try:
+        dropped = open_state_backend().compact_deletions(live, cutoff)
+        state_logger.info("Compacted deletion queue: %s pending, %s stale dropped", len(live), dropped)
+    except Exception as e:
+        logger.error(f"Error compacting deletion queue: {e}")
+
+deletion_scheduler = DeletionScheduler(DELETE_TICK)
+deletion_task = None
+
+def schedule_deletion(chat_id, message_id, delay):
+    deletion_scheduler.schedule(chat_id, message_id, delay)
+
+def load_pending_deletions():
+    try:
+        rows = state_executor.submit(lambda: open_state_backend().load_deletions()).result()
+        overdue, stale = deletion_scheduler.replay(rows)
+        state_logger.info("Pending deletions loaded: %s (%s overdue, %s too old to delete)", deletion_scheduler.size, overdue, stale)
+    except Exception as e:
+        logger.error(f"Error loading pending deletions: {e}")
+
+def load_media_cache():
+    global media_file_ids
+    try:
+        media_file_ids = state_load("media_cache")
+        state_logger.info("Media cache loaded: %s", LogSnippet(media_file_ids))
+    except Exception as e:
+        logger.error(f"Error loading media cache: {e}")
+        media_file_ids = {}
+
+def save_media_cache(path=None):
+    try:
+        persist_state("media_cache", media_file_ids, path)
+        state_logger.debug("Media cache saved: %s", LogSnippet(media_file_ids))
+    except Exception as e:
+        logger.error(f"Error saving media cache: {e}")
+
+def hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+async def reply_media(message, kind, media):
+    if kind == "audio":
+        return await message.reply_audio(audio=media)
+    elif kind == "video":
+        return await message.reply_video(video=media, supports_streaming=True, width=1280, height=720)
+    elif kind == "photo":
+        return await message.reply_photo(photo=media)
+    elif kind == "animation":
+        return await message.reply_animation(animation=media)
+
+def sent_file_id(msg, kind):
+    media = getattr(msg, kind, None)
+    if kind == "photo":
+        return media[-1].file_id if media else None
+    return media.file_id if media else None
+
+def build_asset_registry():
+    registry = {}
+    missing = []
+    preloaded = 0
+    for media_file in dict.fromkeys(keyword_responses.values()):
+        kind = MEDIA_KINDS.get(os.path.splitext(media_file)[1])
+        try:
+            stat = os.stat(media_file)
+            with open(media_file, 'rb') as f:
+                data = f.read() if stat.st_size <= ASSET_PRELOAD_MAX_BYTES and preloaded + stat.st_size <= ASSET_PRELOAD_BUDGET_BYTES else None
+            if data is not None:
+                preloaded += len(data)
+        except OSError:
+            missing.append(media_file)
+            continue
+        registry[media_file] = {
+            "kind": kind, "size": stat.st_size, "mtime": stat.st_mtime_ns,
+            "sha256": hashlib.sha256(data).hexdigest() if data is not None else hash_file(media_file),
+            "data": data
+        }
+    asset_registry.clear()
+    asset_registry.update(registry)
+    logger.info("Asset registry: %d assets, %d bytes preloaded", len(registry), preloaded)
+    if missing:
+        logger.warning("Keyword media files missing: %s", ", ".join(missing))
+
+async def read_asset(media_file):
+    asset = asset_registry[media_file]
+    if asset["data"] is not None:
+        return InputFile(asset["data"], filename=os.path.basename(media_file))
+    def read():
+        with open(media_file, 'rb') as f:
+            return f.read()
+    return InputFile(await asyncio.to_thread(read), filename=os.path.basename(media_file))
+
+def cached_media_file_id(media_file, asset):
+    cached = media_file_ids.get(media_file)
+    if not cached or cached["kind"] != asset["kind"]:
+        return None
+    if cached["sha256"] == asset["sha256"]:
+        # A redeploy may touch mtimes without changing content; only the hash decides
+        if (cached["size"], cached["mtime"]) != (asset["size"], asset["mtime"]):
+            cached.update(size=asset["size"], mtime=asset["mtime"])
+            save_media_cache(media_file)
+        return cached["file_id"]
+    media_cache_stats["invalidations"] += 1
+    del media_file_ids[media_file]
+    save_media_cache(media_file)
+    return None
+
+async def reply_with_keyword_media(message, media_file):
+    asset = asset_registry[media_file]
+    kind = asset["kind"]
+    if kind is None:
+        return None
+    file_id = cached_media_file_id(media_file, asset)
+    if file_id:
+        try:
+            msg = await reply_media(message, kind, file_id)
+            media_cache_stats["hits"] += 1
+            return msg
+        except BadRequest as e:
+            media_cache_stats["rejected"] += 1
+            logger.warning(f"Cached file_id for {media_file} rejected, re-uploading: {e}")
+            media_file_ids.pop(media_file, None)
+            save_media_cache(media_file)
+    msg = await reply_media(message, kind, await read_asset(media_file))
+    media_cache_stats["uploads"] += 1
+    file_id = sent_file_id(msg, kind)
+    if file_id:
+        media_file_ids[media_file] = {
+            "kind": kind, "size": asset["size"], "mtime": asset["mtime"], "sha256": asset["sha256"], "file_id": file_id
+        }
+        save_media_cache(media_file)
+    return msg
+
+MARKDOWN_CACHE_SIZE = int(os.getenv('MARKDOWN_CACHE_SIZE', '1024'))
+MARKDOWN_V2_SPECIAL_CHARS = '_*[]()~`>#+-=|{}.!'
+MARKDOWN_V2_ESCAPES = str.maketrans({char: f"\\{char}" for char in "\\" + MARKDOWN_V2_SPECIAL_CHARS})
+MARKDOWN_V2_TOKENS = re.compile(r"[\\_*\[\]()~`>#+\-=|{}.!]")
+
+def escape_markdown_v2(text):
     if not text:
         return ""
-    special_chars = '_*[]()~`>#+-=|{}.!'
-    processed = text.replace('\\', '\\\\')
-    i = 0
-    result = ""
-    in_bold = False
-    in_italic = False
-    in_link_text = False
-    in_link_url = False
-    while i < len(processed):
-        char = processed[i]
-        next_char = processed[i + 1] if i + 1 < len(processed) else None
-        if char == '*' and not in_link_text and not in_link_url:
-            result += '*'
+    return text.translate(MARKDOWN_V2_ESCAPES)
+
+@functools.lru_cache(maxsize=MARKDOWN_CACHE_SIZE)
+def compile_markdown_v2(text):
+    # *bold*, _italic_ and [text](url) markers pass through; any other special character
+    # outside of them is escaped
+    parts = []
+    last = 0
+    in_bold = in_italic = in_link_text = in_link_url = False
+    for match in MARKDOWN_V2_TOKENS.finditer(text):
+        i = match.start()
+        if i < last:
+            continue  # the "(" already consumed after a "]"
+        parts.append(text[last:i])
+        last = match.end()
+        token = match.group()
+        if token == '\\':
+            parts.append('\\\\')
+        elif token == '*' and not in_link_text and not in_link_url:
+            parts.append('*')
             in_bold = not in_bold
-            i += 1
-            continue
-        elif char == '_' and not in_link_text and not in_link_url:
-            result += '_'
+        elif token == '_' and not in_link_text and not in_link_url:
+            parts.append('_')
             in_italic = not in_italic
-            i += 1
-            continue
-        elif char == '[' and not in_bold and not in_italic and not in_link_text and not in_link_url:
-            result += '['
+        elif token == '[' and not (in_bold or in_italic or in_link_text or in_link_url):
+            parts.append('[')
             in_link_text = True
-            i += 1
-            continue
-        elif char == ']' and in_link_text:
-            result += ']'
+        elif token == ']' and in_link_text:
+            parts.append(']')
             in_link_text = False
-            if next_char == '(':
-                result += '('
+            if text.startswith('(', i + 1):
+                parts.append('(')
                 in_link_url = True
-                i += 2
-                continue
-            else:
-                i += 1
-                continue
-        elif char == ')' and in_link_url:
-            result += ')'
+                last = i + 2
+        elif token == ')' and in_link_url:
+            parts.append(')')
             in_link_url = False
-            i += 1
-            continue
+        elif in_bold or in_italic or in_link_text or in_link_url:
+            parts.append(token)
+        else:
+            parts.append('\\' + token)
+    parts.append(text[last:])
+    return "".join(parts)
+
+def render_markdown_v2(text):
+    if not text:
+        return ""
+    return compile_markdown_v2(text)
+
+WELCOME_TOKENS = re.compile(r"\{username\}|[*_\[\]()]")
+
+def utf16_len(text):
+    if text.isascii():
+        return len(text)
+    return len(text) + sum(1 for char in text if ord(char) > 0xFFFF)
+
+class WelcomeTemplate:
+    """Welcome text compiled to plain-text segments around {username} plus formatting entities.
+
+    Entity offsets and lengths are stored in UTF-16 code units for the static text, along with
+    how many placeholders precede and fall inside each entity, so a send only has to measure
+    the username once.
+    """
+    __slots__ = ("source", "segments", "entities", "entity_cache")
+
+    def __init__(self, source, segments, entities):
+        self.source = source
+        self.segments = segments
+        self.entities = entities  # (type, url, offset, length, placeholders_before, placeholders_inside)
+        # MessageEntity is immutable, so unless a URL embeds the username the list depends only on its length
+        self.entity_cache = None if any(url and "{username}" in url for _, url, *_ in entities) else {}
+
+    def render(self, username):
+        text = username.join(self.segments) if len(self.segments) > 1 else self.segments[0]
+        if not self.entities:
+            return text, []
+        units = utf16_len(username)
+        if self.entity_cache is not None:
+            entities = self.entity_cache.get(units)
+            if entities is None:
+                entities = self.entity_cache[units] = self.build_entities(username, units)
+            return text, entities
+        return text, self.build_entities(username, units)
+
+    def build_entities(self, username, units):
+        return [
+            MessageEntity(
+                type=entity_type,
+                offset=offset + before * units,
+                length=length + inside * units,
+                url=url.replace("{username}", username) if url else None
+            )
+            for entity_type, url, offset, length, before, inside in self.entities
+        ]
+
+def pair_welcome_markers(text, tokens):
+    # Same marker rules as compile_markdown_v2; markers left unclosed stay literal text
+    pairs = {}
+    link_urls = {}
+    open_bold = open_italic = open_link = close_link = None
+    for index, (position, token) in enumerate(tokens):
+        in_link_url = close_link is not None
+        if in_link_url:
+            if token == ')':
+                pairs[open_link] = (MessageEntity.TEXT_LINK, close_link)
+                link_urls[open_link] = (tokens[close_link + 1][0] + 1, position, index)
+                open_link = close_link = None
+        elif open_link is not None:
+            if token == ']':
+                if index + 1 < len(tokens) and tokens[index + 1] == (position + 1, '('):
+                    close_link = index
+                else:
+                    open_link = None
+        elif token == '*':
+            if open_bold is None:
+                open_bold = index
+            else:
+                pairs[open_bold] = (MessageEntity.BOLD, index)
+                open_bold = None
+        elif token == '_':
+            if open_italic is None:
+                open_italic = index
+            else:
+                pairs[open_italic] = (MessageEntity.ITALIC, index)
+                open_italic = None
+        elif token == '[' and open_bold is None and open_italic is None:
+            open_link = index
+    return pairs, link_urls
+
+@functools.lru_cache(maxsize=MARKDOWN_CACHE_SIZE)
+def compile_welcome_template(text):
+    tokens = [(match.start(), match.group()) for match in WELCOME_TOKENS.finditer(text)]
+    pairs, link_urls = pair_welcome_markers(text, tokens)
+    closers = {close: open_ for open_, (_, close) in pairs.items()}
+    segments = []
+    parts = []
+    units = 0
+    placeholders = 0
+    starts = {}
+    entities = []
+    last = 0
+    index = 0
+    while index < len(tokens):
+        position, token = tokens[index]
+        literal = text[last:position]
+        parts.append(literal)
+        units += utf16_len(literal)
+        last = position + len(token)
+        if token == "{username}":
+            segments.append("".join(parts))
+            parts = []
+            placeholders += 1
+        elif index in pairs:
+            starts[index] = (units, placeholders)
+        elif index in closers:
+            open_index = closers[index]
+            entity_type = pairs[open_index][0]
+            start_units, start_placeholders = starts.pop(open_index)
+            url = None
+            if entity_type == MessageEntity.TEXT_LINK:
+                url_start, url_end, paren_index = link_urls[open_index]
+                url = text[url_start:url_end]
+                last = url_end + 1
+                index = paren_index
+            entities.append((entity_type, url, start_units, units - start_units, start_placeholders, placeholders - start_placeholders))
         else:
-            is_in_formatting = in_bold or in_italic or in_link_text or in_link_url
-            if char in special_chars and not is_in_formatting:
-                result += '\\' + char
+            parts.append(token)
+            units += utf16_len(token)
+        index += 1
+    parts.append(text[last:])
+    segments.append("".join(parts))
+    entities.sort(key=lambda entity: (entity[4], entity[2], -entity[3]))
+    return WelcomeTemplate(text, segments, entities)
+
+PARSE_MODE_CACHE_SIZE = int(os.getenv('PARSE_MODE_CACHE_SIZE', '2048'))
+parse_mode_cache = OrderedDict()  # (kind, template text) -> "MarkdownV2" | "entities" | "plain", LRU order
+parse_mode_stats = {"validated": 0, "invalid": 0, "learned": 0, "formatted_sends": 0, "plain_sends": 0}
+MARKDOWN_V2_LINK_SCHEMES = re.compile(r"^(https?|tg)://")
+
+def markdown_v2_error(text):
+    """Why Telegram would reject `text` as MarkdownV2, or None if it should parse."""
+    open_marks = []
+    i = 0
+    length = len(text)
+    while i < length:
+        char = text[i]
+        if char == '\\':
+            if i + 1 >= length:
+                return "trailing backslash"
+            i += 2
+            continue
+        if char == '`':
+            fence = '```' if text.startswith('```', i) else '`'
+            end = i + len(fence)
+            while end < length and not text.startswith(fence, end):
+                end += 2 if text[end] == '\\' else 1
+            if end >= length:
+                return "unclosed code entity"
+            i = end + len(fence)
+            continue
+        mark = None
+        if char in '*~':
+            mark = char
+        elif char == '_':
+            mark = '__' if text.startswith('__', i) else '_'
+        elif char == '|' and text.startswith('||', i):
+            mark = '||'
+        if mark:
+            if mark in open_marks:
+                if open_marks[-1] != mark:
+                    return f"entity '{mark}' closed out of order"
+                open_marks.pop()
             else:
-                result += char
-            i += 1
-    return result
+                open_marks.append(mark)
+            i += len(mark)
+            continue
+        if char == '[':
+            open_marks.append('[')
+        elif char == ']' and open_marks and open_marks[-1] == '[':
+            open_marks.pop()
+            if not text.startswith('(', i + 1):
+                return "link text without URL"
+            end = i + 2
+            while end < length and text[end] != ')':
+                end += 2 if text[end] == '\\' else 1
+            if end >= length:
+                return "unclosed link URL"
+            i = end + 1
+            continue
+        elif char == '>' and (i == 0 or text[i - 1] == '\n'):
+            pass  # block quotation
+        elif char in MARKDOWN_V2_SPECIAL_CHARS:
+            return f"character '{char}' is reserved and must be escaped"
+        i += 1
+    if open_marks:
+        return f"unclosed entity '{open_marks[-1]}'"
+    return None
+
+def welcome_template_error(template):
+    # Offsets shift with the username, so check nesting with a one-unit username
+    spans = sorted(
+        (offset + before, offset + before + length + inside, url)
+        for _, url, offset, length, before, inside in template.entities
+    )
+    open_ends = []
+    for start, end, url in spans:
+        while open_ends and open_ends[-1] <= start:
+            open_ends.pop()
+        if open_ends and end > open_ends[-1]:
+            return "formatting markers overlap"
+        open_ends.append(end)
+        if url is not None and not MARKDOWN_V2_LINK_SCHEMES.match(url):
+            return f"link URL '{url}' must start with http://, https:// or tg://"
+    return None
+
+def remember_parse_mode(key, mode):
+    parse_mode_cache[key] = mode
+    parse_mode_cache.move_to_end(key)
+    while len(parse_mode_cache) > PARSE_MODE_CACHE_SIZE:
+        parse_mode_cache.popitem(last=False)
+
+def known_parse_mode(key, formatted_mode, validate):
+    mode = parse_mode_cache.get(key)
+    if mode is not None:
+        parse_mode_cache.move_to_end(key)
+        return mode
+    error = validate()
+    parse_mode_stats["validated"] += 1
+    if error:
+        parse_mode_stats["invalid"] += 1
+        message_logger.info("Template will be sent as plain text: %s", error)
+    mode = "plain" if error else formatted_mode
+    remember_parse_mode(key, mode)
+    return mode
+
+def markdown_parse_mode(text, formatted_text):
+    return known_parse_mode(("markdown", text), "MarkdownV2", lambda: markdown_v2_error(formatted_text))
+
+def welcome_parse_mode(template):
+    return known_parse_mode(("welcome", template.source), "entities", lambda: welcome_template_error(template))
+
+FORMATTING_ERROR_PHRASES = ("can't parse entities", "wrong http url", "entity")
+
+def is_formatting_error(error):
+    # A bad file_id ("Wrong file identifier/HTTP URL specified") would fail as plain text too
+    message = str(error).lower()
+    if not isinstance(error, BadRequest) or "file identifier" in message:
+        return False
+    return any(phrase in message for phrase in FORMATTING_ERROR_PHRASES)
+
+async def send_text_or_media(context, chat_id, message_type, file_id, text, reply_markup=None, parse_mode=None, entities=None):
+    if message_type == "photo":
+        return await context.bot.send_photo(chat_id, file_id, caption=text, parse_mode=parse_mode, caption_entities=entities, reply_markup=reply_markup)
+    elif message_type == "video":
+        return await context.bot.send_video(chat_id, file_id, caption=text, parse_mode=parse_mode, caption_entities=entities, reply_markup=reply_markup)
+    elif message_type == "animation":
+        return await context.bot.send_animation(chat_id, file_id, caption=text, parse_mode=parse_mode, caption_entities=entities, reply_markup=reply_markup)
+    elif message_type == "audio":
+        return await context.bot.send_audio(chat_id, file_id, caption=text, parse_mode=parse_mode, caption_entities=entities, reply_markup=reply_markup)
+    elif message_type == "voice":
+        return await context.bot.send_voice(chat_id, file_id, caption=text, parse_mode=parse_mode, caption_entities=entities, reply_markup=reply_markup)
+    return await context.bot.send_message(chat_id, text, parse_mode=parse_mode, entities=entities, reply_markup=reply_markup)
 
 async def send_and_delete(context, chat_id, text, timeout_category="admin"):
     timeout = autodelete_config.get(timeout_category, 0)
     msg = await context.bot.send_message(chat_id, text)
     if timeout > 0:
-        context.job_queue.run_once(lambda x: delete_message(x, chat_id, msg.message_id), timeout)
+        schedule_deletion(chat_id, msg.message_id, timeout)
     return msg
 
-async def send_formatted_and_delete(context, chat_id, text, timeout_category="admin", message_type="text", file_id=None, reply_markup=None):
+async def send_formatted_and_delete(context, chat_id, text, timeout_category="admin", message_type="text", file_id=None, reply_markup=None, formatted_text=None):
     timeout = autodelete_config.get(timeout_category, 0)
-    msg = await send_formatted_message(context, chat_id, text, message_type, file_id, reply_markup)
+    msg = await send_formatted_message(context, chat_id, text, message_type, file_id, reply_markup, formatted_text)
     if timeout > 0 and msg:
-        context.job_queue.run_once(lambda x: delete_message(x, chat_id, msg.message_id), timeout)
+        schedule_deletion(chat_id, msg.message_id, timeout)
     return msg
 
-async def send_formatted_message(context, chat_id, text, message_type="text", file_id=None, reply_markup=None):
-    try:
-        formatted_text = process_markdown_v2(text)
-        if message_type == "text":
-            return await context.bot.send_message(chat_id, formatted_text, parse_mode='MarkdownV2', reply_markup=reply_markup)
-        elif message_type == "photo":
-            return await context.bot.send_photo(chat_id, file_id, caption=formatted_text, parse_mode='MarkdownV2', reply_markup=reply_markup)
-        elif message_type == "video":
-            return await context.bot.send_video(chat_id, file_id, caption=formatted_text, parse_mode='MarkdownV2', reply_markup=reply_markup)
-        elif message_type == "animation":
-            return await context.bot.send_animation(chat_id, file_id, caption=formatted_text, parse_mode='MarkdownV2', reply_markup=reply_markup)
-        elif message_type == "audio":
-            return await context.bot.send_audio(chat_id, file_id, caption=formatted_text, parse_mode='MarkdownV2', reply_markup=reply_markup)
-        elif message_type == "voice":
-            return await context.bot.send_voice(chat_id, file_id, caption=formatted_text, parse_mode='MarkdownV2', reply_markup=reply_markup)
-    except Exception as e:
-        logger.error(f"Failed to send with MarkdownV2: {e}")
-        logger.info(f"Falling back to plain text: {text}")
-        if message_type == "text":
-            return await context.bot.send_message(chat_id, text, parse_mode=None, reply_markup=reply_markup)
-        elif message_type == "photo":
-            return await context.bot.send_photo(chat_id, file_id, caption=text, parse_mode=None, reply_markup=reply_markup)
-        elif message_type == "video":
-            return await context.bot.send_video(chat_id, file_id, caption=text, parse_mode=None, reply_markup=reply_markup)
-        elif message_type == "animation":
-            return await context.bot.send_animation(chat_id, file_id, caption=text, parse_mode=None, reply_markup=reply_markup)
-        elif message_type == "audio":
-            return await context.bot.send_audio(chat_id, file_id, caption=text, parse_mode=None, reply_markup=reply_markup)
-        elif message_type == "voice":
-            return await context.bot.send_voice(chat_id, file_id, caption=text, parse_mode=None, reply_markup=reply_markup)
+async def send_formatted_message(context, chat_id, text, message_type="text", file_id=None, reply_markup=None, formatted_text=None):
+    if message_type not in ("text", "photo", "video", "animation", "audio", "voice"):
+        return None
+    if formatted_text is None:
+        formatted_text = render_markdown_v2(text)
+    if markdown_parse_mode(text, formatted_text) == "MarkdownV2":
+        try:
+            msg = await send_text_or_media(context, chat_id, message_type, file_id, formatted_text, reply_markup, parse_mode='MarkdownV2')
+            parse_mode_stats["formatted_sends"] += 1
+            return msg
+        except BadRequest as e:
+            if not is_formatting_error(e):
+                raise
+            # Learn from the failure so later sends of this text skip straight to plain text
+            logger.error(f"Failed to send with MarkdownV2: {e}")
+            remember_parse_mode(("markdown", text), "plain")
+            parse_mode_stats["learned"] += 1
+            message_logger.info("Falling back to plain text: %s", LogSnippet(text))
+    parse_mode_stats["plain_sends"] += 1
+    return await send_text_or_media(context, chat_id, message_type, file_id, text, reply_markup)
 
 async def send_welcome_message(context, chat_id, welcome_config, username):
     try:
         message_type = welcome_config.get("type", "text")
         file_id = welcome_config.get("file_id")
         raw_text = welcome_config.get("text", "")
-        text_with_username = raw_text.replace("{username}", username)
-        logger.info(f"Original welcome text: {raw_text}")
-        logger.info(f"After username replacement: {text_with_username}")
         timeout = autodelete_config.get("welcome", 0)
-        try:
-            formatted_text = process_markdown_v2(text_with_username)
-            logger.info(f"Formatted for MarkdownV2: {formatted_text}")
-            if message_type == "text":
-                msg = await context.bot.send_message(chat_id, formatted_text, parse_mode='MarkdownV2')
-            elif message_type == "photo":
-                msg = await context.bot.send_photo(chat_id, file_id, caption=formatted_text, parse_mode='MarkdownV2')
-            elif message_type == "video":
-                msg = await context.bot.send_video(chat_id, file_id, caption=formatted_text, parse_mode='MarkdownV2')
-            elif message_type == "animation":
-                msg = await context.bot.send_animation(chat_id, file_id, caption=formatted_text, parse_mode='MarkdownV2')
-            else:
-                msg = await context.bot.send_message(chat_id, formatted_text, parse_mode='MarkdownV2')
-            if timeout > 0 and msg:
-                context.job_queue.run_once(lambda x: delete_message(x, chat_id, msg.message_id), timeout)
-            return msg
-        except Exception as e:
-            logger.error(f"Error sending welcome with MarkdownV2: {e}")
-            logger.info("Falling back to plain text...")
-            if message_type == "text":
-                msg = await context.bot.send_message(chat_id, text_with_username)
-            elif message_type == "photo":
-                msg = await context.bot.send_photo(chat_id, file_id, caption=text_with_username)
-            elif message_type == "video":
-                msg = await context.bot.send_video(chat_id, file_id, caption=text_with_username)
-            elif message_type == "animation":
-                msg = await context.bot.send_animation(chat_id, file_id, caption=text_with_username)
-            else:
-                msg = await context.bot.send_message(chat_id, text_with_username)
-            if timeout > 0 and msg:
-                context.job_queue.run_once(lambda x: delete_message(x, chat_id, msg.message_id), timeout)
-            return msg
+        template = welcome_templates.get(chat_id)
+        if template is None or template.source != raw_text:
+            template = compile_welcome_template(raw_text)
+        msg = None
+        if welcome_parse_mode(template) == "entities":
+            text, entities = template.render(username)
+            message_logger.debug("Welcome text for %s: %s (%d entities)", username, text, len(entities))
+            try:
+                # Formatting travels as precomputed entities, so Telegram never has to parse markup
+                msg = await send_text_or_media(context, chat_id, message_type, file_id, text, entities=entities)
+                parse_mode_stats["formatted_sends"] += 1
+            except BadRequest as e:
+                if not is_formatting_error(e):
+                    raise
+                logger.error(f"Error sending welcome with entities: {e}")
+                remember_parse_mode(("welcome", raw_text), "plain")
+                parse_mode_stats["learned"] += 1
+                message_logger.info("Falling back to plain text...")
+        if msg is None:
+            msg = await send_text_or_media(context, chat_id, message_type, file_id, raw_text.replace("{username}", username))
+            parse_mode_stats["plain_sends"] += 1
+        if timeout > 0 and msg:
+            schedule_deletion(chat_id, msg.message_id, timeout)
+        return msg
     except Exception as e:
         logger.error(f"Failed to send welcome message: {e}")
         return None
 
-def adjust_entities(original_text, new_text, entities):
-    if not entities or "{username}" not in original_text:
-        return entities
-    username_len = len("{username}")
-    username_start = original_text.index("{username}")
-    new_username = new_text[username_start:username_start + (len(new_text) - len(original_text) + username_len)]
-    offset_diff = len(new_username) - username_len
-    adjusted_entities = []
-    for entity in entities:
-        new_offset = entity.offset
-        if entity.offset > username_start:
-            new_offset += offset_diff
-        new_length = entity.length
-        if username_start <= entity.offset < username_start + username_len:
-            new_length += offset_diff
-        adjusted_entity = MessageEntity(
-            type=entity.type,
-            offset=new_offset,
-            length=new_length,
-            url=entity.url if entity.type == MessageEntity.TEXT_LINK else None
-        )
-        adjusted_entities.append(adjusted_entity)
-    return adjusted_entities
-
 def generate_captcha():
     num1 = random.randint(1, 10)
     num2 = random.randint(1, 10)
@@ -422,9 +1912,7 @@ async def resolve_user(chat_id: int, target_user: str, context: ContextTypes.DEF
     try:
         if target_user.startswith("@"):
             username = target_user[1:].lower()
-            if chat_id in user_id_cache and username in user_id_cache[chat_id]:
-                return user_id_cache[chat_id][username]
-            return None
+            return user_id_cache.lookup(chat_id, username)
         else:
             return int(target_user)
     except ValueError:
@@ -436,10 +1924,59 @@ async def get_user_id_from_reply(update: Update) -> int or None:
         return update.message.reply_to_message.from_user.id
     return None
 
+async def fetch_admin_ids(chat_id: int) -> frozenset:
+    generation = admin_cache_generation.get(chat_id, 0)
+    admins = await application.bot.get_chat_administrators(chat_id)
+    admin_ids = frozenset(admin.user.id for admin in admins)
+    if admin_cache_generation.get(chat_id, 0) != generation:
+        # An admin change arrived while this call was in flight; its list may predate the change
+        return admin_ids
+    admin_cache[chat_id] = (time.monotonic() + ADMIN_CACHE_TTL, admin_ids)
+    admin_cache.move_to_end(chat_id)
+    while len(admin_cache) > ADMIN_CACHE_MAX_CHATS:
+        admin_cache.popitem(last=False)
+        admin_cache_stats["evictions"] += 1
+    return admin_ids
+
+async def is_admin(chat_id: int, user_id: int) -> bool:
+    entry = admin_cache.get(chat_id)
+    if entry and entry[0] > time.monotonic():
+        admin_cache.move_to_end(chat_id)
+        admin_cache_stats["hits"] += 1
+        return user_id in entry[1]
+    admin_cache_stats["misses"] += 1
+    # Concurrent misses for the same chat share one getChatAdministrators call
+    task = admin_cache_pending.get(chat_id)
+    if task is None:
+        task = asyncio.ensure_future(fetch_admin_ids(chat_id))
+        admin_cache_pending[chat_id] = task
+        task.add_done_callback(lambda done: admin_cache_pending.get(chat_id) is done and admin_cache_pending.pop(chat_id))
+    # Shielded so one caller being cancelled does not cancel the fetch for the others sharing it
+    return user_id in await asyncio.shield(task)
+
+def invalidate_admin_cache(chat_id: int):
+    admin_cache_generation[chat_id] = admin_cache_generation.get(chat_id, 0) + 1
+    # Later checks start a fresh fetch instead of joining one that may return the old admin list
+    admin_cache_pending.pop(chat_id, None)
+    if admin_cache.pop(chat_id, None) is not None:
+        admin_cache_stats["invalidations"] += 1
+        logger.info(f"Admin cache invalidated for chat {chat_id}")
+
+async def handle_chat_member_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        member_update = update.chat_member or update.my_chat_member
+        if not member_update:
+            return
+        admin_statuses = (ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER)
+        if member_update.old_chat_member.status in admin_statuses or member_update.new_chat_member.status in admin_statuses:
+            invalidate_admin_cache(member_update.chat.id)
+    except Exception as e:
+        logger.error(f"Error handling chat member update: {e}")
+
 async def delete_message(context: ContextTypes.DEFAULT_TYPE, chat_id: int, message_id: int):
     try:
         await context.bot.delete_message(chat_id=chat_id, message_id=message_id)
-        logger.info(f"Deleted message {message_id} in chat {chat_id}")
+        message_logger.info("Deleted message %s in chat %s", message_id, chat_id)
     except Exception as e:
         logger.error(f"Failed to delete message {message_id}: {e}")
 
@@ -447,7 +1984,7 @@ async def add_solexa_room(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.message.chat.type == "private":
         await send_and_delete(context, update.message.chat_id, "Group-only command ❌", "error")
         return
-    if update.message.from_user.id not in [admin.user.id for admin in await update.effective_chat.get_administrators()]:
+    if not await is_admin(update.message.chat_id, update.message.from_user.id):
         await send_and_delete(context, update.message.chat_id, "No permission ❌", "error")
         return
     chat_id = update.message.chat_id
@@ -464,14 +2001,14 @@ async def add_solexa_room(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await send_and_delete(context, chat_id, "Chat ID must be a number (e.g., -1001234567890)", "error")
         return
     chat_ids_map[tag] = target_chat_id
-    save_chat_ids()
+    save_chat_ids(tag)
     await send_and_delete(context, chat_id, f"Room '{tag}' with chat ID {target_chat_id} added ✅", "admin")
 
 async def remove_solexa_room(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.message.chat.type == "private":
         await send_and_delete(context, update.message.chat_id, "Group-only command ❌", "error")
         return
-    if update.message.from_user.id not in [admin.user.id for admin in await update.effective_chat.get_administrators()]:
+    if not await is_admin(update.message.chat_id, update.message.from_user.id):
         await send_and_delete(context, update.message.chat_id, "No permission ❌", "error")
         return
     chat_id = update.message.chat_id
@@ -484,17 +2021,83 @@ async def remove_solexa_room(update: Update, context: ContextTypes.DEFAULT_TYPE)
         return
     if tag in chat_ids_map:
         del chat_ids_map[tag]
-        save_chat_ids()
+        save_chat_ids(tag)
         await send_and_delete(context, chat_id, f"Room '{tag}' removed ✅", "admin")
     else:
         await send_and_delete(context, chat_id, f"Room '{tag}' not found ❌", "error")
 
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+global_send_bucket = TokenBucket(BOT_SEND_RATE, max(1, int(BOT_SEND_RATE)))
+
+async def acquire_send_slot(chat_id):
+    bucket = chat_send_buckets.get(chat_id)
+    if bucket is None:
+        bucket = chat_send_buckets[chat_id] = TokenBucket(CHAT_SEND_RATE, CHAT_SEND_BURST)
+        # The least recently used bucket has long refilled, so dropping it loses no rate history
+        while len(chat_send_buckets) > CHAT_SEND_BUCKETS_MAX:
+            chat_send_buckets.popitem(last=False)
+    else:
+        chat_send_buckets.move_to_end(chat_id)
+    await bucket.acquire()
+    await global_send_bucket.acquire()
+
+def retry_after_seconds(error):
+    delay = error.retry_after
+    return delay.total_seconds() if isinstance(delay, timedelta) else float(delay)
+
+async def deliver_broadcast(context, target_chat_id, content, media_type=None, file_id=None):
+    started = time.monotonic()
+    attempts = 0
+    error = None
+    while attempts < BROADCAST_MAX_ATTEMPTS:
+        attempts += 1
+        await acquire_send_slot(target_chat_id)
+        try:
+            await send_formatted_and_delete(context, target_chat_id, content, "system", message_type=media_type or "text", file_id=file_id)
+            message_logger.info("Broadcast sent to %s after %d attempt(s)", target_chat_id, attempts)
+            return {"chat_id": target_chat_id, "ok": True, "attempts": attempts, "seconds": time.monotonic() - started, "error": None}
+        except RetryAfter as e:
+            error = e
+            await asyncio.sleep(retry_after_seconds(e))
+        except (BadRequest, Forbidden) as e:
+            error = e
+            break
+        except (TimedOut, NetworkError) as e:
+            error = e
+            await asyncio.sleep(0.5 * 2 ** attempts)
+        except Exception as e:
+            error = e
+            break
+    logger.error(f"Failed to broadcast to {target_chat_id} after {attempts} attempt(s): {error}")
+    return {"chat_id": target_chat_id, "ok": False, "attempts": attempts, "seconds": time.monotonic() - started, "error": str(error)}
+
+async def run_broadcast(context, targets, content, media_type=None, file_id=None):
+    return await asyncio.gather(*(deliver_broadcast(context, target, content, media_type, file_id) for target in targets))
+
 async def broadcast_message(update: Update, context: ContextTypes.DEFAULT_TYPE, message_text: str, media_type=None, file_id=None):
     chat_id = update.message.chat_id
     if update.message.chat.type == "private":
         await send_and_delete(context, chat_id, "Group-only command ❌", "error")
         return
-    if update.message.from_user.id not in [admin.user.id for admin in await update.effective_chat.get_administrators()]:
+    if not await is_admin(update.message.chat_id, update.message.from_user.id):
         await send_and_delete(context, chat_id, "No permission ❌", "error")
         return
     
@@ -546,26 +2149,152 @@ async def broadcast_message(update: Update, context: ContextTypes.DEFAULT_TYPE,
         await send_and_delete(context, chat_id, "No valid chat targets specified", "error")
         return
 
-    failed_chats = []
-    for target_chat_id in valid_targets:
+    started = time.monotonic()
+    report = await run_broadcast(context, valid_targets, broadcast_content, media_type, file_id)
+    elapsed = time.monotonic() - started
+    failed = [result for result in report if not result["ok"]]
+    if failed:
+        details = ", ".join(f"{result['chat_id']} ({result['error']})" for result in failed)
+        await send_and_delete(context, chat_id, f"Broadcast sent to {len(report) - len(failed)}/{len(report)} chats in {elapsed:.1f}s, but failed for chats: {details}", "admin")
+    else:
+        await send_and_delete(context, chat_id, f"Broadcast sent to all specified chats ✅ ({len(report)} chats in {elapsed:.1f}s)", "admin")
+
+def record_joins(chat_id, count):
+    now = time.monotonic()
+    history = join_history.get(chat_id)
+    if history is None:
+        history = join_history[chat_id] = deque(maxlen=RAID_JOIN_THRESHOLD)
+    history.extend([now] * min(count, RAID_JOIN_THRESHOLD))
+    while history and history[0] < now - RAID_WINDOW:
+        history.popleft()
+    if len(history) >= RAID_JOIN_THRESHOLD:
+        if raid_until.get(chat_id, 0) < now:
+            raid_stats["raids"] += 1
+            logger.warning("Join burst in chat %s, batching captchas and welcomes", chat_id)
+        raid_until[chat_id] = now + RAID_COOLDOWN
+    return raid_until.get(chat_id, 0) >= now
+
+def in_raid_mode(chat_id):
+    return raid_until.get(chat_id, 0) >= time.monotonic()
+
+def join_names(usernames):
+    names = ", ".join(usernames[:RAID_MAX_NAMES])
+    if len(usernames) > RAID_MAX_NAMES:
+        names += f" and {len(usernames) - RAID_MAX_NAMES} more"
+    return names
+
+async def send_new_welcome(context, chat_id, username):
+    if chat_id in welcome_auto_delete and welcome_auto_delete[chat_id]:
+        # Old welcomes go out in bulk from the deletion scheduler; the new one is not held up
+        retired = retire_welcomes(chat_id)
+        if retired:
+            message_logger.info("Queued %s old welcome messages for deletion in chat %s", retired, chat_id)
+    msg = await send_welcome_message(context, chat_id, welcome_state[chat_id], username)
+    if msg:
+        track_welcome(chat_id, msg.message_id)
+        message_logger.info("Welcome message sent successfully, message_id: %s", msg.message_id)
+    return msg
+
+def schedule_raid_flush(context, chat_id):
+    if chat_id not in raid_flush_tasks:
+        raid_flush_tasks[chat_id] = asyncio.create_task(flush_raid_batch(context, chat_id))
+
+async def restrict_new_member(context, chat_id, user_id):
+    await global_send_bucket.acquire()
+    await context.bot.restrict_chat_member(chat_id, user_id, ChatPermissions(can_send_messages=False))
+
+async def flush_raid_batch(context, chat_id):
+    try:
+        await asyncio.sleep(RAID_BATCH_WINDOW)
+    except asyncio.CancelledError:
+        pass  # cancelled by flush_raid_batches at shutdown: send the batch now rather than drop it
+    finally:
+        raid_flush_tasks.pop(chat_id, None)
+    members = raid_joins.pop(chat_id, [])
+    usernames = raid_welcomes.pop(chat_id, [])
+    try:
+        if members:
+            raid_stats["batches"] += 1
+            raid_stats["batched_members"] += len(members)
+            results = await asyncio.gather(*(restrict for _, _, restrict in members), return_exceptions=True)
+            restricted = []
+            for (user_id, username, _), result in zip(members, results):
+                if isinstance(result, Exception):
+                    logger.error(f"Failed to restrict {user_id} in chat {chat_id}: {result}")
+                else:
+                    restricted.append((user_id, username))
+            if restricted:
+                # One shared question for the whole batch; whoever taps is checked against their own entry
+                question, options, correct_answer = generate_captcha()
+                deadline = time.time() + CAPTCHA_TIMEOUT
+                for user_id, username in restricted:
+                    captcha_store.add(CaptchaEntry(chat_id, user_id, correct_answer, username, deadline, batch=True))
+                    captcha_stats["issued"] += 1
+                keyboard = [[InlineKeyboardButton(str(opt), callback_data=f"captcha_0_{opt}")] for opt in options]
+                names = join_names([username for _, username in restricted])
+                msg = await send_formatted_and_delete(
+                    context, chat_id, f"Welcome {names}! Please verify yourselves.\n\n{question}",
+                    "captcha_prompt", reply_markup=InlineKeyboardMarkup(keyboard)
+                )
+                if msg:
+                    captcha_batches[(chat_id, msg.message_id)] = {user_id for user_id, _ in restricted}
+                    for user_id, _ in restricted:
+                        entry = captcha_store.get(chat_id, user_id)
+                        if entry is not None:
+                            entry.prompt_id = msg.message_id
+                            captcha_store.save(chat_id, user_id)
+        if usernames and chat_id in welcome_state and welcome_state[chat_id]["enabled"]:
+            raid_stats["batched_welcomes"] += 1
+            await send_new_welcome(context, chat_id, join_names(usernames))
+    except Exception as e:
+        logger.error(f"Error flushing join batch for chat {chat_id}: {e}")
+
+async def flush_raid_batches():
+    # Cut every pending batch window short so restricted joiners still get their captcha prompt
+    tasks = list(raid_flush_tasks.values())
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+async def resolve_captcha_batch_member(bot, chat_id, prompt_id, user_id):
+    pending = captcha_batches.get((chat_id, prompt_id))
+    if pending is None:
+        return
+    pending.discard(user_id)
+    if not pending:
+        del captcha_batches[(chat_id, prompt_id)]
+        try:
+            await bot.delete_message(chat_id, prompt_id)
+        except Exception as e:
+            logger.error(f"Failed to delete captcha prompt {prompt_id}: {e}")
+
+async def expire_captchas(bot):
+    for entry in captcha_store.pop_expired(time.time()):
+        captcha_stats["expired"] += 1
         try:
-            await send_formatted_and_delete(
-                context,
-                target_chat_id,
-                broadcast_content,
-                "system",
-                message_type=media_type or "text",
-                file_id=file_id
-            )
-            logger.info(f"Broadcast sent to {target_chat_id}")
+            await bot.ban_chat_member(entry.chat_id, entry.user_id)
+            await bot.unban_chat_member(entry.chat_id, entry.user_id)
+            message_logger.info("Removed %s from chat %s after captcha timeout", entry.user_id, entry.chat_id)
         except Exception as e:
-            logger.error(f"Failed to broadcast to {target_chat_id}: {e}")
-            failed_chats.append(target_chat_id)
-    
-    if failed_chats:
-        await send_and_delete(context, chat_id, f"Broadcast sent, but failed for chats: {', '.join(map(str, failed_chats))}", "admin")
-    else:
-        await send_and_delete(context, chat_id, "Broadcast sent to all specified chats ✅", "admin")
+            captcha_stats["kick_errors"] += 1
+            logger.error(f"Failed to remove unverified user {entry.user_id} from chat {entry.chat_id}: {e}")
+        if entry.prompt_id is None:
+            continue
+        if entry.batch:
+            await resolve_captcha_batch_member(bot, entry.chat_id, entry.prompt_id, entry.user_id)
+        else:
+            try:
+                await bot.delete_message(entry.chat_id, entry.prompt_id)
+            except Exception:
+                pass  # already removed by its auto-delete timer
+
+async def captcha_expiry_worker(bot):
+    while True:
+        await asyncio.sleep(CAPTCHA_SWEEP_INTERVAL)
+        try:
+            await expire_captchas(bot)
+        except Exception as e:
+            logger.error(f"Error expiring captchas: {e}")
 
 async def welcome_new_member(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
@@ -574,45 +2303,43 @@ async def welcome_new_member(update: Update, context: ContextTypes.DEFAULT_TYPE)
         if clean_system:
             try:
                 await context.bot.delete_message(chat_id=chat_id, message_id=update.message.message_id)
-                logger.info(f"Deleted system message {update.message.message_id} in chat {chat_id}")
+                message_logger.info("Deleted system message %s in chat %s", update.message.message_id, chat_id)
             except Exception as e:
                 logger.error(f"Failed to delete system message {update.message.message_id}: {e}")
         if chat_id not in captcha_enabled:
             captcha_enabled[chat_id] = True
-            save_captcha_state()
+            save_captcha_state(chat_id)
         captcha_active = captcha_enabled[chat_id]
-        for member in update.message.new_chat_members:
+        members = update.message.new_chat_members
+        raid = record_joins(chat_id, len(members))
+        for member in members:
             user_id = member.id
             username = member.username or member.first_name
-            logger.info(f"New member: {username} (ID: {user_id}) in {update.message.chat.title}")
-            if chat_id not in user_id_cache:
-                user_id_cache[chat_id] = {}
+            message_logger.info("New member: %s (ID: %s) in %s", username, user_id, update.message.chat.title)
             if member.username:
-                user_id_cache[chat_id][member.username.lower()] = user_id
-            if captcha_active:
+                user_id_cache.remember(chat_id, member.username, user_id)
+            if raid:
+                if captcha_active:
+                    # Mute right away; only the prompt waits for the batch window
+                    restrict = asyncio.create_task(restrict_new_member(context, chat_id, user_id))
+                    raid_joins.setdefault(chat_id, []).append((user_id, username, restrict))
+                else:
+                    raid_welcomes.setdefault(chat_id, []).append(username)
+                schedule_raid_flush(context, chat_id)
+            elif captcha_active:
                 permissions = ChatPermissions(can_send_messages=False)
                 await context.bot.restrict_chat_member(chat_id, user_id, permissions)
                 question, options, correct_answer = generate_captcha()
-                captcha_attempts[user_id] = {"answer": correct_answer, "attempts": 0, "chat_id": chat_id, "username": username}
+                entry = captcha_store.add(CaptchaEntry(chat_id, user_id, correct_answer, username, time.time() + CAPTCHA_TIMEOUT))
+                captcha_stats["issued"] += 1
                 keyboard = [[InlineKeyboardButton(str(opt), callback_data=f"captcha_{user_id}_{opt}")] for opt in options]
                 reply_markup = InlineKeyboardMarkup(keyboard)
-                await send_formatted_and_delete(context, chat_id, f"Welcome {username}! Please verify yourself.\n\n{question}", "captcha_prompt", reply_markup=reply_markup)
-            else:
-                if chat_id in welcome_state and welcome_state[chat_id]["enabled"]:
-                    if chat_id in welcome_auto_delete and welcome_auto_delete[chat_id]:
-                        if "message_ids" in welcome_state[chat_id]:
-                            for msg_id in welcome_state[chat_id]["message_ids"][:]:
-                                try:
-                                    await context.bot.delete_message(chat_id, msg_id)
-                                    welcome_state[chat_id]["message_ids"].remove(msg_id)
-                                    logger.info(f"Auto-deleted old welcome message {msg_id}")
-                                except Exception as e:
-                                    logger.error(f"Failed to auto-delete welcome message {msg_id}: {e}")
-                    msg = await send_welcome_message(context, chat_id, welcome_state[chat_id], username)
-                    if msg:
-                        welcome_state[chat_id].setdefault("message_ids", []).append(msg.message_id)
-                        save_welcome_state()
-                        logger.info(f"Welcome message sent successfully, message_id: {msg.message_id}")
+                msg = await send_formatted_and_delete(context, chat_id, f"Welcome {username}! Please verify yourself.\n\n{question}", "captcha_prompt", reply_markup=reply_markup)
+                if msg:
+                    entry.prompt_id = msg.message_id
+                    captcha_store.save(chat_id, user_id)
+            elif chat_id in welcome_state and welcome_state[chat_id]["enabled"]:
+                await send_new_welcome(context, chat_id, username)
     except Exception as e:
         logger.error(f"Error handling new member: {e}")
 
@@ -649,7 +2376,7 @@ async def handle_system_messages(update: Update, context: ContextTypes.DEFAULT_T
         if is_system_message:
             try:
                 await context.bot.delete_message(chat_id=chat_id, message_id=update.message.message_id)
-                logger.info(f"Deleted system message {update.message.message_id} in chat {chat_id}")
+                message_logger.info("Deleted system message %s in chat %s", update.message.message_id, chat_id)
             except Exception as e:
                 logger.error(f"Failed to delete system message: {e}")
     except Exception as e:
@@ -665,50 +2392,56 @@ async def verify_captcha(update: Update, context: ContextTypes.DEFAULT_TYPE):
         _, target_user_id, answer = data
         target_user_id = int(target_user_id)
         answer = int(answer)
-        if user_id != target_user_id:
+        batch_prompt = target_user_id == 0  # raid-mode prompt shared by a batch of new members
+        if batch_prompt:
+            target_user_id = user_id
+        elif user_id != target_user_id:
             await query.answer("❌ Unauthorized", show_alert=True)
             return
-        if target_user_id not in captcha_attempts:
+        chat_id = query.message.chat_id
+        entry = captcha_store.get(chat_id, target_user_id)
+        if entry is None:
             await query.answer("Expired")
             return
-        correct_answer = captcha_attempts[target_user_id]["answer"]
-        chat_id = captcha_attempts[target_user_id]["chat_id"]
-        username = captcha_attempts[target_user_id]["username"]
-        attempts = captcha_attempts[target_user_id]["attempts"]
-        if answer == correct_answer:
+        if batch_prompt and entry.prompt_id != query.message.message_id:
+            await query.answer("❌ Unauthorized", show_alert=True)
+            return
+        username = entry.username
+        if answer == entry.answer:
             permissions = ChatPermissions(
                 can_send_messages=True, can_send_photos=True, can_send_videos=True,
                 can_send_other_messages=True, can_send_polls=True, can_add_web_page_previews=True
             )
             await context.bot.restrict_chat_member(chat_id, target_user_id, permissions)
-            await query.message.delete()
-            if chat_id in welcome_state and welcome_state[chat_id]["enabled"]:
-                if chat_id in welcome_auto_delete and welcome_auto_delete[chat_id]:
-                    if "message_ids" in welcome_state[chat_id]:
-                        for msg_id in welcome_state[chat_id]["message_ids"][:]:
-                            try:
-                                await context.bot.delete_message(chat_id, msg_id)
-                                welcome_state[chat_id]["message_ids"].remove(msg_id)
-                                logger.info(f"Auto-deleted old welcome message {msg_id}")
-                            except Exception as e:
-                                logger.error(f"Failed to auto-delete welcome message {msg_id}: {e}")
-                msg = await send_welcome_message(context, chat_id, welcome_state[chat_id], username)
-                if msg:
-                    welcome_state[chat_id].setdefault("message_ids", []).append(msg.message_id)
-                    save_welcome_state()
-                    logger.info(f"Welcome message sent successfully, message_id: {msg.message_id}")
+            captcha_store.pop(chat_id, target_user_id)
+            captcha_stats["verified"] += 1
+            if batch_prompt:
+                await query.answer("✅ Verified!")
+                await resolve_captcha_batch_member(context.bot, chat_id, query.message.message_id, target_user_id)
             else:
+                await query.message.delete()
+            if chat_id in welcome_state and welcome_state[chat_id]["enabled"]:
+                if in_raid_mode(chat_id):
+                    raid_welcomes.setdefault(chat_id, []).append(username)
+                    schedule_raid_flush(context, chat_id)
+                else:
+                    await send_new_welcome(context, chat_id, username)
+            elif not batch_prompt:
                 await send_and_delete(context, chat_id, "✅ Verified!", "captcha")
-            del captcha_attempts[target_user_id]
         else:
-            attempts += 1
-            captcha_attempts[target_user_id]["attempts"] = attempts
-            if attempts >= 3:
+            entry.attempts += 1
+            if entry.attempts >= 3:
                 await context.bot.ban_chat_member(chat_id, target_user_id)
                 await context.bot.unban_chat_member(chat_id, target_user_id)
-                await query.message.edit_text("❌ Removed after 3 failed attempts")
-                del captcha_attempts[target_user_id]
+                captcha_store.pop(chat_id, target_user_id)
+                captcha_stats["failed"] += 1
+                if batch_prompt:
+                    await query.answer("❌ Removed after 3 failed attempts", show_alert=True)
+                    await resolve_captcha_batch_member(context.bot, chat_id, query.message.message_id, target_user_id)
+                else:
+                    await query.message.edit_text("❌ Removed after 3 failed attempts")
             else:
+                captcha_store.save(chat_id, target_user_id)
                 await query.answer("❌ Incorrect answer")
     except Exception as e:
         logger.error(f"Captcha error: {e}")
@@ -720,36 +2453,18 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         chat_id = update.message.chat_id
         user = update.message.from_user
         if user.username:
-            if chat_id not in user_id_cache:
-                user_id_cache[chat_id] = {}
-            user_id_cache[chat_id][user.username.lower()] = user.id
+            user_id_cache.remember(chat_id, user.username, user.id)
         message_text = update.message.text.strip().lower()
-        if chat_id in filters_dict:
-            for keyword, response in filters_dict[chat_id].items():
-                if message_text == keyword or message_text == f"/{keyword}":
-                    if isinstance(response, dict) and 'type' in response and 'file_id' in response:
-                        media_type = response['type']
-                        file_id = response['file_id']
-                        text = response.get('text', '')
-                        await send_formatted_and_delete(context, chat_id, text, "filter", media_type, file_id)
-                    elif isinstance(response, str):
-                        await send_formatted_and_delete(context, chat_id, response, "filter")
-                    return
-        for keyword, media_file in keyword_responses.items():
-            if message_text == keyword:
-                if not os.path.exists(media_file):
-                    await send_and_delete(context, chat_id, f"File missing: {media_file}", "error")
-                    return
-                with open(media_file, 'rb') as media:
-                    if media_file.endswith('.mp3'):
-                        await update.message.reply_audio(audio=media)
-                    elif media_file.endswith('.mp4'):
-                        await update.message.reply_video(video=media, supports_streaming=True, width=1280, height=720)
-                    elif media_file.endswith('.jpg'):
-                        await update.message.reply_photo(photo=media)
-                    elif media_file.endswith('.gif'):
-                        await update.message.reply_animation(animation=media)
-                break
+        keyword = find_filter(chat_id, message_text)
+        if keyword is not None:
+            await send_filter_response(context, chat_id, keyword)
+            return
+        media_file = keyword_responses.get(message_text)
+        if media_file:
+            if media_file not in asset_registry:
+                await send_and_delete(context, chat_id, f"File missing: {media_file}", "error")
+                return
+            await reply_with_keyword_media(update.message, media_file)
     except Exception as e:
         logger.error(f"Message error: {e}")
 
@@ -759,25 +2474,28 @@ async def handle_command_as_filter(update: Update, context: ContextTypes.DEFAULT
             return
         message_text = update.message.text.strip().lower()
         chat_id = update.message.chat_id
-        if chat_id in filters_dict:
-            for keyword, response in filters_dict[chat_id].items():
-                if message_text == f"/{keyword}":
-                    if isinstance(response, dict) and 'type' in response and 'file_id' in response:
-                        media_type = response['type']
-                        file_id = response['file_id']
-                        text = response.get('text', '')
-                        await send_formatted_and_delete(context, chat_id, text, "filter", media_type, file_id)
-                    elif isinstance(response, str):
-                        await send_formatted_and_delete(context, chat_id, response, "filter")
-                    return
+        keyword = find_filter(chat_id, message_text, commands_only=True)
+        if keyword is not None:
+            await send_filter_response(context, chat_id, keyword)
     except Exception as e:
         logger.error(f"Filter error: {e}")
 
+async def send_filter_response(context, chat_id, keyword):
+    response = filters_dict[chat_id][keyword]
+    formatted_text = filter_templates.get(chat_id, {}).get(keyword)
+    if isinstance(response, dict) and 'type' in response and 'file_id' in response:
+        media_type = response['type']
+        file_id = response['file_id']
+        text = response.get('text', '')
+        await send_formatted_and_delete(context, chat_id, text, "filter", media_type, file_id, formatted_text=formatted_text)
+    elif isinstance(response, str):
+        await send_formatted_and_delete(context, chat_id, response, "filter", formatted_text=formatted_text)
+
 async def cleansystem_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.message.chat.type == "private":
         await send_and_delete(context, update.message.chat_id, "Group-only command ❌", "error")
         return
-    if update.message.from_user.id not in [admin.user.id for admin in await update.effective_chat.get_administrators()]:
+    if not await is_admin(update.message.chat_id, update.message.from_user.id):
         await send_and_delete(context, update.message.chat_id, "No permission ❌", "error")
         return
     chat_id = update.message.chat_id
@@ -787,11 +2505,11 @@ async def cleansystem_command(update: Update, context: ContextTypes.DEFAULT_TYPE
     action = context.args[0].upper()
     if action == "ON":
         cleansystem_enabled[chat_id] = True
-        save_cleansystem_state()
+        save_cleansystem_state(chat_id)
         await send_and_delete(context, chat_id, "System message cleaning enabled ✅", "system")
     elif action == "OFF":
         cleansystem_enabled[chat_id] = False
-        save_cleansystem_state()
+        save_cleansystem_state(chat_id)
         await send_and_delete(context, chat_id, "System message cleaning disabled ✅", "system")
     elif action == "STATUS":
         state = cleansystem_enabled.get(chat_id, False)
@@ -804,7 +2522,7 @@ async def solexaautodelete_command(update: Update, context: ContextTypes.DEFAULT
     if update.message.chat.type == "private":
         await send_and_delete(context, update.message.chat_id, "Group-only command ❌", "error")
         return
-    if update.message.from_user.id not in [admin.user.id for admin in await update.effective_chat.get_administrators()]:
+    if not await is_admin(update.message.chat_id, update.message.from_user.id):
         await send_and_delete(context, update.message.chat_id, "No permission ❌", "error")
         return
     chat_id = update.message.chat_id
@@ -825,7 +2543,7 @@ async def solexaautodelete_command(update: Update, context: ContextTypes.DEFAULT
             await send_and_delete(context, chat_id, "Seconds must be 0 or positive", "error")
             return
         autodelete_config[category] = seconds
-        save_autodelete_config()
+        save_autodelete_config(category)
         status = "disabled" if seconds == 0 else f"set to {seconds}s"
         await send_and_delete(context, chat_id, f"Auto-delete for {category} {status} ✅", "admin")
     except ValueError:
@@ -834,7 +2552,7 @@ async def solexahelp_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
     if update.message.chat.type == "private":
         await send_and_delete(context, update.message.chat_id, "Group-only command ❌", "error")
         return
-    if update.message.from_user.id not in [admin.user.id for admin in await update.effective_chat.get_administrators()]:
+    if not await is_admin(update.message.chat_id, update.message.from_user.id):
         await send_and_delete(context, update.message.chat_id, "No permission ❌", "error")
         return
     help_text = (
@@ -859,7 +2577,8 @@ async def solexahelp_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
         "• `/addsolexafilter keyword [text]`: Add media filter (with media).\n"
         "• `/listsolexafilters`: List filters (admin only).\n"
         "• `/solexafilters`: Show filter keywords (all members).\n"
-        "• `/removesolexafilter keyword`: Remove filter.\n\n"
+        "• `/removesolexafilter keyword`: Remove filter.\n"
+        "• `/solexafiltermode EXACT|CONTAINS|STATUS`: Match filters on the whole message or anywhere in it.\n\n"
         "*🔒 Captcha*\n"
         "• `/solexacaptcha ON|OFF|status`: Toggle captcha.\n\n"
         "*👋 Welcome Messages*\n"
@@ -885,7 +2604,7 @@ async def solexacaptcha_command(update: Update, context: ContextTypes.DEFAULT_TY
     if update.message.chat.type == "private":
         await send_and_delete(context, update.message.chat_id, "Group-only command ❌", "error")
         return
-    if update.message.from_user.id not in [admin.user.id for admin in await update.effective_chat.get_administrators()]:
+    if not await is_admin(update.message.chat_id, update.message.from_user.id):
         await send_and_delete(context, update.message.chat_id, "No permission ❌", "error")
         return
     chat_id = update.message.chat_id
@@ -895,11 +2614,11 @@ async def solexacaptcha_command(update: Update, context: ContextTypes.DEFAULT_TY
     action = context.args[0].upper()
     if action == "ON":
         captcha_enabled[chat_id] = True
-        save_captcha_state()
+        save_captcha_state(chat_id)
         await send_and_delete(context, chat_id, "Captcha enabled ✅", "admin")
     elif action == "OFF":
         captcha_enabled[chat_id] = False
-        save_captcha_state()
+        save_captcha_state(chat_id)
         await send_and_delete(context, chat_id, "Captcha disabled ✅", "admin")
     elif action == "STATUS":
         state = captcha_enabled.get(chat_id, True)
@@ -912,12 +2631,12 @@ async def setsolexawelcome_command(update: Update, context: ContextTypes.DEFAULT
     if update.message.chat.type == "private":
         await send_and_delete(context, update.message.chat_id, "Group-only command ❌", "error")
         return
-    if update.message.from_user.id not in [admin.user.id for admin in await update.effective_chat.get_administrators()]:
+    if not await is_admin(update.message.chat_id, update.message.from_user.id):
         await send_and_delete(context, update.message.chat_id, "No permission ❌", "error")
         return
     chat_id = update.message.chat_id
     if chat_id not in welcome_state:
-        welcome_state[chat_id] = {"enabled": False, "type": None, "file_id": None, "text": "", "entities": [], "message_ids": []}
+        welcome_state[chat_id] = {"enabled": False, "type": None, "file_id": None, "text": "", "entities": []}
     args = update.message.text.split(maxsplit=1)
     if len(args) < 2:
         await send_and_delete(context, chat_id, "Usage: /setsolexawelcome <message> or ON|OFF|status|preview", "admin")
@@ -926,11 +2645,11 @@ async def setsolexawelcome_command(update: Update, context: ContextTypes.DEFAULT
     if subcommand in ["ON", "OFF", "STATUS", "PREVIEW"]:
         if subcommand == "ON":
             welcome_state[chat_id]["enabled"] = True
-            save_welcome_state()
+            save_welcome_state(chat_id)
             await send_and_delete(context, chat_id, "Welcome message enabled ✅", "admin")
         elif subcommand == "OFF":
             welcome_state[chat_id]["enabled"] = False
-            save_welcome_state()
+            save_welcome_state(chat_id)
             await send_and_delete(context, chat_id, "Welcome message disabled ✅", "admin")
         elif subcommand == "STATUS":
             enabled = welcome_state[chat_id]["enabled"]
@@ -955,15 +2674,15 @@ async def setsolexawelcome_command(update: Update, context: ContextTypes.DEFAULT
     else:
         text = args[1]
         entities = parse_markdown_entities(text)
-        welcome_state[chat_id].update({"enabled": True, "type": "text", "file_id": None, "text": text, "entities": entities, "message_ids": []})
-        save_welcome_state()
-        await send_and_delete(context, chat_id, "Welcome text set ✅", "admin")
+        welcome_state[chat_id].update({"enabled": True, "type": "text", "file_id": None, "text": text, "entities": entities})
+        save_welcome_state(chat_id)
+        await send_and_delete(context, chat_id, f"Welcome text set ✅{welcome_format_note(chat_id)}", "admin")
 
 async def setsolexawelcome_autodelete_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.message.chat.type == "private":
         await send_and_delete(context, update.message.chat_id, "Group-only command ❌", "error")
         return
-    if update.message.from_user.id not in [admin.user.id for admin in await update.effective_chat.get_administrators()]:
+    if not await is_admin(update.message.chat_id, update.message.from_user.id):
         await send_and_delete(context, update.message.chat_id, "No permission ❌", "error")
         return
     chat_id = update.message.chat_id
@@ -973,11 +2692,11 @@ async def setsolexawelcome_autodelete_command(update: Update, context: ContextTy
     action = context.args[0].upper()
     if action == "ON":
         welcome_auto_delete[chat_id] = True
-        save_welcome_autodelete_state()
+        save_welcome_autodelete_state(chat_id)
         await send_and_delete(context, chat_id, "Welcome message auto-delete enabled ✅", "admin")
     elif action == "OFF":
         welcome_auto_delete[chat_id] = False
-        save_welcome_autodelete_state()
+        save_welcome_autodelete_state(chat_id)
         await send_and_delete(context, chat_id, "Welcome message auto-delete disabled ✅", "admin")
     elif action == "STATUS":
         state = welcome_auto_delete.get(chat_id, False)
@@ -987,17 +2706,16 @@ async def setsolexawelcome_autodelete_command(update: Update, context: ContextTy
         await send_and_delete(context, chat_id, "Usage: /setsolexawelcomeautodelete ON|OFF|STATUS", "admin")
 
 async def handle_media_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    logger.info(f"Entered handle_media_message for update: {update.message}")
+    message_logger.debug("Entered handle_media_message for message %s in chat %s", update.message.message_id, update.message.chat_id)
     if not update.message.caption:
-        logger.info("Message skipped: No caption")
+        message_logger.debug("Message skipped: No caption")
         return
     if update.message.chat.type == "private":
         await send_and_delete(context, update.message.chat_id, "Group-only command ❌", "error")
         return
     chat_id = update.message.chat_id
     try:
-        admins = await update.effective_chat.get_administrators()
-        if update.message.from_user.id not in [admin.user.id for admin in admins]:
+        if not await is_admin(chat_id, update.message.from_user.id):
             await send_and_delete(context, chat_id, "No permission ❌", "error")
             return
     except Exception as e:
@@ -1078,8 +2796,9 @@ async def handle_media_message(update: Update, context: ContextTypes.DEFAULT_TYP
                     file_id = update.message.document.file_id
             if media_type and file_id:
                 filters_dict[chat_id][keyword] = {'type': media_type, 'file_id': file_id, 'text': raw_text}
-                await send_and_delete(context, chat_id, f"{media_type.capitalize()} filter '{keyword}' added ✅", "admin")
-                save_filters()
+                index_filter(chat_id, keyword)
+                await send_and_delete(context, chat_id, f"{media_type.capitalize()} filter '{keyword}' added ✅{filter_format_note(chat_id, keyword)}", "admin")
+                save_filters(chat_id)
             else:
                 await send_and_delete(context, chat_id, "No supported media type detected", "error")
         except Exception as e:
@@ -1089,28 +2808,28 @@ async def handle_media_message(update: Update, context: ContextTypes.DEFAULT_TYP
         args = caption.split(maxsplit=1)
         raw_caption = args[1] if len(args) > 1 else ""
         if chat_id not in welcome_state:
-            welcome_state[chat_id] = {"enabled": False, "type": None, "file_id": None, "text": "", "entities": [], "message_ids": []}
+            welcome_state[chat_id] = {"enabled": False, "type": None, "file_id": None, "text": "", "entities": []}
         try:
             if update.message.photo:
                 file_id = update.message.photo[-1].file_id
-                welcome_state[chat_id].update({"enabled": True, "type": "photo", "file_id": file_id, "text": raw_caption, "entities": [], "message_ids": []})
+                welcome_state[chat_id].update({"enabled": True, "type": "photo", "file_id": file_id, "text": raw_caption, "entities": []})
             elif update.message.video:
                 file_id = update.message.video.file_id
-                welcome_state[chat_id].update({"enabled": True, "type": "video", "file_id": file_id, "text": raw_caption, "entities": [], "message_ids": []})
+                welcome_state[chat_id].update({"enabled": True, "type": "video", "file_id": file_id, "text": raw_caption, "entities": []})
             elif update.message.animation:
                 file_id = update.message.animation.file_id
-                welcome_state[chat_id].update({"enabled": True, "type": "animation", "file_id": file_id, "text": raw_caption, "entities": [], "message_ids": []})
+                welcome_state[chat_id].update({"enabled": True, "type": "animation", "file_id": file_id, "text": raw_caption, "entities": []})
             else:
                 await send_and_delete(context, chat_id, "Unsupported media type", "error")
                 return
-            save_welcome_state()
-            await send_and_delete(context, chat_id, f"{welcome_state[chat_id]['type'].capitalize()} welcome set ✅", "admin")
+            save_welcome_state(chat_id)
+            await send_and_delete(context, chat_id, f"{welcome_state[chat_id]['type'].capitalize()} welcome set ✅{welcome_format_note(chat_id)}", "admin")
         except Exception as e:
             logger.error(f"Error setting media welcome message: {e}")
             await send_and_delete(context, chat_id, "Error setting welcome message ❌", "error")
 
 async def ban_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.message.chat.type != "private" and update.message.from_user.id in [admin.user.id for admin in await update.effective_chat.get_administrators()]:
+    if update.message.chat.type != "private" and await is_admin(update.message.chat_id, update.message.from_user.id):
         try:
             target_user = context.args[0] if context.args else None
             if not target_user:
@@ -1130,7 +2849,7 @@ async def ban_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await send_and_delete(context, update.message.chat_id, "No permission ❌", "error")
 
 async def kick_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.message.chat.type != "private" and update.message.from_user.id in [admin.user.id for admin in await update.effective_chat.get_administrators()]:
+    if update.message.chat.type != "private" and await is_admin(update.message.chat_id, update.message.from_user.id):
         try:
             target_user = context.args[0] if context.args else None
             if not target_user:
@@ -1151,7 +2870,7 @@ async def kick_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await send_and_delete(context, update.message.chat_id, "No permission ❌", "error")
 
 async def mute_user(update: Update, context: ContextTypes.DEFAULT_TYPE, duration: timedelta):
-    if update.message.chat.type != "private" and update.message.from_user.id in [admin.user.id for admin in await update.effective_chat.get_administrators()]:
+    if update.message.chat.type != "private" and await is_admin(update.message.chat_id, update.message.from_user.id):
         try:
             target_user = context.args[0] if context.args else None
             if not target_user:
@@ -1182,7 +2901,7 @@ async def mute1hr(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await mute_user(update, context, timedelta(hours=1))
 
 async def unmute_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.message.chat.type != "private" and update.message.from_user.id in [admin.user.id for admin in await update.effective_chat.get_administrators()]:
+    if update.message.chat.type != "private" and await is_admin(update.message.chat_id, update.message.from_user.id):
         try:
             target_user = context.args[0] if context.args else None
             if not target_user:
@@ -1206,7 +2925,7 @@ async def unmute_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await send_and_delete(context, update.message.chat_id, "No permission ❌", "error")
 
 async def unban_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.message.chat.type != "private" and update.message.from_user.id in [admin.user.id for admin in await update.effective_chat.get_administrators()]:
+    if update.message.chat.type != "private" and await is_admin(update.message.chat_id, update.message.from_user.id):
         try:
             target_user = context.args[0] if context.args else None
             if not target_user:
@@ -1226,7 +2945,7 @@ async def unban_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await send_and_delete(context, update.message.chat_id, "No permission ❌", "error")
 
 async def add_text_filter(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.message.chat.type != "private" and update.message.from_user.id in [admin.user.id for admin in await update.effective_chat.get_administrators()]:
+    if update.message.chat.type != "private" and await is_admin(update.message.chat_id, update.message.from_user.id):
         chat_id = update.message.chat_id
         if not context.args or len(context.args) < 2:
             await send_and_delete(context, chat_id, "Usage: /addsolexafilter keyword text", "admin")
@@ -1236,13 +2955,14 @@ async def add_text_filter(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if chat_id not in filters_dict:
             filters_dict[chat_id] = {}
         filters_dict[chat_id][keyword] = response_text
-        save_filters()
-        await send_and_delete(context, chat_id, f"Text filter '{keyword}' added ✅", "admin")
+        index_filter(chat_id, keyword)
+        save_filters(chat_id)
+        await send_and_delete(context, chat_id, f"Text filter '{keyword}' added ✅{filter_format_note(chat_id, keyword)}", "admin")
     else:
         await send_and_delete(context, update.message.chat_id, "No permission ❌", "error")
 
 async def list_filters(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.message.chat.type != "private" and update.message.from_user.id in [admin.user.id for admin in await update.effective_chat.get_administrators()]:
+    if update.message.chat.type != "private" and await is_admin(update.message.chat_id, update.message.from_user.id):
         chat_id = update.message.chat_id
         filters_list = filters_dict.get(chat_id, {})
         if filters_list:
@@ -1275,13 +2995,14 @@ async def solexafilters_command(update: Update, context: ContextTypes.DEFAULT_TY
         await send_and_delete(context, chat_id, "No filters available in this group.", "filter")
 
 async def remove_filter(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.message.chat.type != "private" and update.message.from_user.id in [admin.user.id for admin in await update.effective_chat.get_administrators()]:
+    if update.message.chat.type != "private" and await is_admin(update.message.chat_id, update.message.from_user.id):
         try:
             keyword = context.args[0].lower()
             chat_id = update.message.chat_id
             if chat_id in filters_dict and keyword in filters_dict[chat_id]:
                 del filters_dict[chat_id][keyword]
-                save_filters()
+                unindex_filter(chat_id, keyword)
+                save_filters(chat_id)
                 await send_and_delete(context, chat_id, f"Filter '{keyword}' removed ✅", "admin")
             else:
                 await send_and_delete(context, chat_id, "Filter not found ❌", "error")
@@ -1290,11 +3011,34 @@ async def remove_filter(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         await send_and_delete(context, update.message.chat_id, "No permission ❌", "error")
 
+async def solexafiltermode_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.message.chat.type == "private":
+        await send_and_delete(context, update.message.chat_id, "Group-only command ❌", "error")
+        return
+    if not await is_admin(update.message.chat_id, update.message.from_user.id):
+        await send_and_delete(context, update.message.chat_id, "No permission ❌", "error")
+        return
+    chat_id = update.message.chat_id
+    if not context.args:
+        await send_and_delete(context, chat_id, "Usage: /solexafiltermode EXACT|CONTAINS|STATUS", "admin")
+        return
+    action = context.args[0].upper()
+    if action in ("EXACT", "CONTAINS"):
+        filter_match_mode[chat_id] = action.lower()
+        filter_automata.pop(chat_id, None)
+        save_filter_mode(chat_id)
+        await send_and_delete(context, chat_id, f"Filter matching set to {action.lower()} ✅", "admin")
+    elif action == "STATUS":
+        mode = filter_match_mode.get(chat_id, "exact")
+        await send_and_delete(context, chat_id, f"Filter matching is currently {mode}", "admin")
+    else:
+        await send_and_delete(context, chat_id, "Usage: /solexafiltermode EXACT|CONTAINS|STATUS", "admin")
+
 async def solexafixwelcome_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.message.chat.type == "private":
         await send_and_delete(context, update.message.chat_id, "Group-only command ❌", "error")
         return
-    if update.message.from_user.id not in [admin.user.id for admin in await update.effective_chat.get_administrators()]:
+    if not await is_admin(update.message.chat_id, update.message.from_user.id):
         await send_and_delete(context, update.message.chat_id, "No permission ❌", "error")
         return
     chat_id = update.message.chat_id
@@ -1312,8 +3056,9 @@ async def solexafixwelcome_command(update: Update, context: ContextTypes.DEFAULT
     username = update.message.from_user.username or update.message.from_user.first_name
     sample_text = original_text.replace("{username}", username)
     await send_and_delete(context, chat_id, f"Raw sample with your username:\n{sample_text}", "admin")
-    processed_text = process_markdown_v2(sample_text)
-    await send_and_delete(context, chat_id, f"Processed markdown: \n{processed_text}", "admin")
+    rendered_text, entities = compile_welcome_template(original_text).render(username)
+    entity_text = "\n".join(f"- {entity.type} at {entity.offset}+{entity.length}" + (f" -> {entity.url}" if entity.url else "") for entity in entities)
+    await send_and_delete(context, chat_id, f"Rendered text: \n{rendered_text}\n\nEntities:\n{entity_text or 'none'}", "admin")
 
 async def solexabroadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not update.message.text:
@@ -1340,6 +3085,7 @@ application.add_handler(CommandHandler("addsolexafilter", add_text_filter))
 application.add_handler(CommandHandler("listsolexafilters", list_filters))
 application.add_handler(CommandHandler("solexafilters", solexafilters_command))
 application.add_handler(CommandHandler("removesolexafilter", remove_filter))
+application.add_handler(CommandHandler("solexafiltermode", solexafiltermode_command))
 application.add_handler(CommandHandler("solexafixwelcome", solexafixwelcome_command))
 application.add_handler(CommandHandler("solexabroadcast", solexabroadcast_command))
 application.add_handler(CommandHandler("addsolexaroom", add_solexa_room))
@@ -1354,28 +3100,378 @@ application.add_handler(MessageHandler(
 ))
 application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
 application.add_handler(MessageHandler(filters.COMMAND, handle_command_as_filter))
-application.add_handler(CallbackQueryHandler(verify_captcha, pattern=r"^captcha_\d+_\d+$"))
+CAPTCHA_CALLBACK_PATTERN = re.compile(r"^captcha_\d+_\d+$")
+captcha_handler = CallbackQueryHandler(verify_captcha, pattern=CAPTCHA_CALLBACK_PATTERN)
+application.add_handler(captcha_handler)
+application.add_handler(ChatMemberHandler(handle_chat_member_update, ChatMemberHandler.ANY_CHAT_MEMBER))
+if METRICS_ENABLED:
+    instrument_handlers(application)
+
+class UpdateDeduplicator:
+    """Remembers the last `size` update_ids: a ring buffer for eviction order, a set for O(1) lookups."""
+    __slots__ = ("ring", "seen", "position")
+
+    def __init__(self, size):
+        self.ring = [None] * max(1, size)
+        self.seen = set()
+        self.position = 0
+
+    def check_and_add(self, update_id):
+        """Return None for a duplicate, otherwise the ring slot the update_id now occupies."""
+        if update_id in self.seen:
+            return None
+        slot = self.position
+        evicted = self.ring[self.position]
+        if evicted is not None:
+            self.seen.discard(evicted)
+        self.ring[self.position] = update_id
+        self.position = (self.position + 1) % len(self.ring)
+        self.seen.add(update_id)
+        return slot
+
+    def forget(self, update_id, slot):
+        # Clear the slot too, or its later eviction would discard the id after a redelivery re-added it elsewhere
+        if self.ring[slot] == update_id:
+            self.ring[slot] = None
+            self.seen.discard(update_id)
+
+update_deduplicator = UpdateDeduplicator(UPDATE_DEDUP_WINDOW)
+
+def update_chat_id(data):
+    for field in ("message", "edited_message", "channel_post", "edited_channel_post",
+                  "chat_member", "my_chat_member", "chat_join_request", "message_reaction"):
+        chat = (data.get(field) or {}).get("chat")
+        if chat:
+            return chat.get("id", 0)
+    callback = data.get("callback_query")
+    if callback:
+        chat = (callback.get("message") or {}).get("chat")
+        return chat.get("id", 0) if chat else (callback.get("from") or {}).get("id", 0)
+    return 0
+
+# Update types some handler acts on; Telegram is asked for only these, anything else is dropped
+HANDLED_UPDATE_TYPES = ("message", "callback_query", "chat_member", "my_chat_member")
+triage_stats = {"ignored_type": 0, "ignored_callback": 0, "private_service": 0, "text_fast": 0, "captcha": 0, "dispatch": 0}
+
+def is_command(message):
+    return any(entity.get("type") == "bot_command" and entity.get("offset") == 0 for entity in message.get("entities") or ())
+
+def triage_update(data):
+    """Classify a raw update without building PTB objects: "drop", "text", "captcha" or "dispatch"."""
+    message = data.get("message")
+    if message is not None:
+        if "text" in message and not is_command(message):
+            return "text"  # only handle_message takes plain text
+        if (message.get("chat") or {}).get("type") == "private" and "text" not in message and "caption" not in message:
+            triage_stats["private_service"] += 1
+            return "drop"
+        return "dispatch"
+    callback = data.get("callback_query")
+    if callback is not None:
+        if CAPTCHA_CALLBACK_PATTERN.match(callback.get("data") or ""):
+            return "captcha"
+        triage_stats["ignored_callback"] += 1
+        return "drop"
+    if any(field in data for field in HANDLED_UPDATE_TYPES):
+        return "dispatch"
+    triage_stats["ignored_type"] += 1
+    return "drop"
+
+def handle_plain_text(message):
+    """Fast path for plain text: returns True when no reply is needed, so the update can skip dispatch."""
+    chat_id = message["chat"]["id"]
+    user = message.get("from") or {}
+    if user.get("username"):
+        user_id_cache.remember(chat_id, user["username"], user["id"])
+    message_text = message["text"].strip().lower()
+    return find_filter(chat_id, message_text) is None and message_text not in keyword_responses
+
+def update_queue_depth():
+    return sum(queue.qsize() for queue in update_queues)
+
+async def update_worker(queue):
+    while True:
+        enqueued_at, route, data = await queue.get()
+        wait_ms = (time.monotonic() - enqueued_at) * 1000
+        update_queue_stats["total_wait_ms"] += wait_ms
+        update_queue_stats["max_wait_ms"] = max(update_queue_stats["max_wait_ms"], wait_ms)
+        try:
+            if route == "text" and handle_plain_text(data["message"]):
+                triage_stats["text_fast"] += 1
+            elif route == "captcha":
+                # One known handler: skip the walk over every registered handler's filters
+                triage_stats["captcha"] += 1
+                update = Update.de_json(data, application.bot)
+                await captcha_handler.callback(update, application.context_types.context.from_update(update, application))
+            else:
+                triage_stats["dispatch"] += 1
+                update = Update.de_json(data, application.bot)
+                await application.process_update(update)
+            update_queue_stats["processed"] += 1
+        except Exception as e:
+            update_queue_stats["failed"] += 1
+            logger.error(f"Error processing update {data.get('update_id')}: {e}")
+        finally:
+            queue.task_done()
+
+def start_update_workers():
+    global accepting_updates
+    shard_size = max(1, UPDATE_QUEUE_SIZE // max(1, UPDATE_WORKERS))
+    for _ in range(max(1, UPDATE_WORKERS)):
+        queue = asyncio.Queue(maxsize=shard_size)
+        update_queues.append(queue)
+        update_workers.append(asyncio.create_task(update_worker(queue)))
+    accepting_updates = True
+    logger.info(f"Started {len(update_workers)} update workers, {shard_size} queued updates each")
+
+async def drain_update_queues():
+    global accepting_updates
+    accepting_updates = False
+    try:
+        await asyncio.wait_for(asyncio.gather(*(queue.join() for queue in update_queues)), UPDATE_DRAIN_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.error(f"Update queue drain timed out with {update_queue_depth()} updates pending")
+    for worker in update_workers:
+        worker.cancel()
+    await asyncio.gather(*update_workers, return_exceptions=True)
+    update_workers.clear()
+    update_queues.clear()
+
+UPDATE_RECORD_DIR = os.getenv('UPDATE_RECORD_DIR', '')  # set to record accepted updates for benchmarks/replay_updates.py
+UPDATE_RECORD_REDACT = os.getenv('UPDATE_RECORD_REDACT', 'names').lower()  # "none", "names" or "all" (names plus message text)
+UPDATE_RECORD_MAX_BYTES = int(os.getenv('UPDATE_RECORD_MAX_BYTES', str(64 * 1024 * 1024)))  # uncompressed bytes per file
+UPDATE_RECORD_KEEP = int(os.getenv('UPDATE_RECORD_KEEP', '10'))
+REDACTED_NAME_FIELDS = frozenset({"first_name", "last_name", "username", "phone_number", "email", "bio"})
+DROPPED_PII_FIELDS = frozenset({"contact", "location", "venue"})
+
+class UpdateRecorder:
+    """Appends accepted updates to rotating gzip JSONL files from a background thread."""
+
+    def __init__(self, directory, max_bytes, keep, redact):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.keep = keep
+        self.redact = redact
+        self.salt = os.getenv('UPDATE_RECORD_SALT') or os.urandom(8).hex()
+        self.queue = SimpleQueue()
+        self.thread = None
+        self.file = None
+        self.written = 0
+        self.stats = {"recorded": 0, "files": 0, "errors": 0}
+
+    def record(self, data):
+        if self.thread is None:
+            os.makedirs(self.directory, exist_ok=True)
+            self.thread = threading.Thread(target=self.run, name="update-recorder", daemon=True)
+            self.thread.start()
+        self.queue.put((time.time(), data))
+
+    def pseudonym(self, value):
+        # Stable per salt, so the same user keeps the same name across a recording
+        return "u" + hashlib.sha256(f"{self.salt}:{value}".encode()).hexdigest()[:10]
+
+    def scrub(self, value):
+        if isinstance(value, dict):
+            scrubbed = {}
+            for key, item in value.items():
+                if key in DROPPED_PII_FIELDS:
+                    continue
+                if key in REDACTED_NAME_FIELDS and isinstance(item, str):
+                    scrubbed[key] = self.pseudonym(item)
+                elif self.redact == "all" and key in ("text", "caption") and isinstance(item, str):
+                    # Keep a leading command so replays still hit the same handler
+                    command, _, rest = item.partition(" ") if item.startswith("/") else ("", "", item)
+                    scrubbed[key] = command + (" " if command and rest else "") + "x" * len(rest)
+                else:
+                    scrubbed[key] = self.scrub(item)
+            return scrubbed
+        if isinstance(value, list):
+            return [self.scrub(item) for item in value]
+        return value
+
+    def open_file(self):
+        if self.file is not None:
+            self.file.close()
+        name = time.strftime("updates-%Y%m%d-%H%M%S", time.gmtime()) + f"-{self.stats['files']}.jsonl.gz"
+        self.file = gzip.open(os.path.join(self.directory, name), "at", encoding="utf-8")
+        self.written = 0
+        self.stats["files"] += 1
+        recordings = sorted(f for f in os.listdir(self.directory) if f.startswith("updates-") and f.endswith(".jsonl.gz"))
+        for old in recordings[:-self.keep] if self.keep > 0 else []:
+            os.remove(os.path.join(self.directory, old))
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            batch = [item]
+            while not self.queue.empty():
+                batch.append(self.queue.get())
+            try:
+                for entry in batch:
+                    if entry is None:
+                        continue
+                    received_at, data = entry
+                    if self.file is None or self.written >= self.max_bytes:
+                        self.open_file()
+                    payload = data if self.redact == "none" else self.scrub(data)
+                    line = json.dumps({"t": received_at, "update": payload}, ensure_ascii=False) + "\n"
+                    self.file.write(line)
+                    self.written += len(line.encode())
+                    self.stats["recorded"] += 1
+                if self.file is not None:
+                    self.file.flush()
+            except Exception as e:
+                self.stats["errors"] += 1
+                logger.error(f"Error recording updates: {e}")
+            if None in batch:
+                if self.file is not None:
+                    self.file.close()
+                    self.file = None
+                return
+
+    def stop(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join(timeout=5)
+            self.thread = None
+
+update_recorder = UpdateRecorder(UPDATE_RECORD_DIR, UPDATE_RECORD_MAX_BYTES, UPDATE_RECORD_KEEP, UPDATE_RECORD_REDACT) if UPDATE_RECORD_DIR else None
+
+def collect_stat_groups():
+    return {
+        "admin_cache": admin_cache_stats,
+        "state_flush": state_flush_stats,
+        "update_queue": dict(update_queue_stats, depth=update_queue_depth()),
+        "media_cache": media_cache_stats,
+        "parse_mode": parse_mode_stats,
+        "raid": raid_stats,
+        "captcha": dict(captcha_stats, **captcha_store.gauges()),
+        "user_index": dict(user_id_cache.stats, **user_id_cache.gauges()),
+        "deletions": dict(deletion_scheduler.stats, **deletion_scheduler.gauges()),
+        "welcome_lifecycle": welcome_lifecycle_stats,
+        "update_recorder": update_recorder.stats if update_recorder else {},
+        "triage": triage_stats,
+        "startup": startup_timings,
+        **{f"transport_{pool}": stats for pool, stats in transport_stats.items()},
+    }
+
+@app.get("/metrics")
+async def metrics():
+    if not METRICS_ENABLED:
+        return PlainTextResponse("metrics disabled\n", status_code=404)
+    lines = render_latency_metrics("solexa_handler_duration", "handler", handler_metrics)
+    lines += render_latency_metrics("solexa_api_request_duration", "method", api_metrics)
+    lines += render_latency_metrics("solexa_api_pool_wait", "pool", pool_wait_metrics)
+    # Counters and gauges kept by the caches and queues, one series per field
+    lines.append("# TYPE solexa_stat gauge")
+    for group, stats in collect_stat_groups().items():
+        for key, value in stats.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                lines.append(f'solexa_stat{{group="{group}",name="{prometheus_label(key)}"}} {value}')
+    return PlainTextResponse("\n".join(lines) + "\n", media_type="text/plain; version=0.0.4")
 
 @app.post("/telegram")
 async def telegram_webhook(request: Request):
-    data = await request.json()
-    logger.info(f"Received update: {json.dumps(data, indent=2)}")
-    update = Update.de_json(data, application.bot)
-    await application.process_update(update)
+    if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+        return JSONResponse({"status": "forbidden"}, status_code=403)
+    try:
+        data = json_loads(await request.body())
+    except ValueError:
+        return JSONResponse({"status": "invalid json"}, status_code=400)
+    if not isinstance(data, dict) or not isinstance(data.get("update_id"), int):
+        return JSONResponse({"status": "invalid update"}, status_code=400)
+    update_logger.debug("Received update %s", data["update_id"])
+    if UPDATE_LOG_SAMPLE_RATE and random.random() < UPDATE_LOG_SAMPLE_RATE:
+        update_logger.info("Sampled update: %s", LazyJSON(data))
+    route = triage_update(data)
+    if route == "drop":
+        return {"status": "ignored"}
+    if not accepting_updates:
+        return JSONResponse({"status": "unavailable"}, status_code=503)
+    dedup_slot = update_deduplicator.check_and_add(data["update_id"])
+    if dedup_slot is None:
+        update_queue_stats["duplicates"] += 1
+        update_logger.info("Dropping duplicate update %s", data["update_id"])
+        return {"status": "duplicate"}
+    queue = update_queues[update_chat_id(data) % len(update_queues)]
+    try:
+        await asyncio.wait_for(queue.put((time.monotonic(), route, data)), UPDATE_ENQUEUE_TIMEOUT)
+    except asyncio.TimeoutError:
+        # Non-2xx makes Telegram redeliver later instead of us dropping the update
+        update_deduplicator.forget(data["update_id"], dedup_slot)
+        update_queue_stats["rejected"] += 1
+        update_logger.warning("Update queue full, rejecting update %s", data["update_id"])
+        return JSONResponse({"status": "busy"}, status_code=503)
+    update_queue_stats["enqueued"] += 1
+    update_queue_stats["max_depth"] = max(update_queue_stats["max_depth"], update_queue_depth())
+    if update_recorder is not None:
+        update_recorder.record(data)
     return {"status": "ok"}
 
-@app.on_event("startup")
-async def startup():
+startup_timings = {}  # phase -> milliseconds, for the cold-start benchmark and /metrics
+
+def load_all_state():
+    started = time.perf_counter()
     load_filters()
+    load_filter_mode()
     load_captcha_state()
     load_welcome_state()
+    load_welcome_messages()
     load_cleansystem_state()
     load_autodelete_config()
     load_welcome_autodelete_state()
     load_chat_ids()
+    load_media_cache()
+    load_captcha_pending()
+    load_user_index()
+    load_pending_deletions()
+    startup_timings["state_ms"] = (time.perf_counter() - started) * 1000
+
+def build_asset_registry_timed():
+    started = time.perf_counter()
+    build_asset_registry()
+    startup_timings["assets_ms"] = (time.perf_counter() - started) * 1000
+
+async def initialize_application():
+    started = time.perf_counter()
     await application.initialize()
+    startup_timings["initialize_ms"] = (time.perf_counter() - started) * 1000
+
+@app.on_event("startup")
+async def startup():
+    started = time.perf_counter()
+    # State reads and asset hashing run in threads while getMe is in flight; none of them touch the others' globals
+    await asyncio.gather(asyncio.to_thread(load_all_state), asyncio.to_thread(build_asset_registry_timed), initialize_application())
     await application.start()
-    await application.bot.set_webhook(WEBHOOK_URL)
+    start_update_workers()
+    global captcha_expiry_task, deletion_task
+    captcha_expiry_task = asyncio.create_task(captcha_expiry_worker(application.bot))
+    deletion_task = asyncio.create_task(deletion_scheduler.run(application.bot))
+    webhook_started = time.perf_counter()
+    # chat_member updates are opt-in; they drive admin cache invalidation
+    await application.bot.set_webhook(WEBHOOK_URL, allowed_updates=list(HANDLED_UPDATE_TYPES), secret_token=WEBHOOK_SECRET)
+    startup_timings["webhook_ms"] = (time.perf_counter() - webhook_started) * 1000
+    startup_timings["total_ms"] = (time.perf_counter() - started) * 1000
+    logger.info("Startup finished in %.0f ms: %s", startup_timings["total_ms"], startup_timings)
+
+@app.on_event("shutdown")
+async def shutdown():
+    await drain_update_queues()
+    await flush_raid_batches()
+    if update_recorder is not None:
+        await asyncio.to_thread(update_recorder.stop)
+    for task in (captcha_expiry_task, deletion_task):
+        if task is not None:
+            task.cancel()
+    await application.stop()
+    await application.shutdown()
+    await flush_dirty_state()
+    deletion_scheduler.flush_journal()
+    await asyncio.to_thread(flush_state_writes)
+    state_executor.shutdown(wait=True)
+    stop_logging()
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=10000)
\ No newline at end of file
+    import uvicorn  # only the server entry point needs it; benchmarks import this module without it
+    # log_config=None routes uvicorn's loggers through the same non-blocking queue handler
+    uvicorn.run(app, host="0.0.0.0", port=10000, log_config=None)
\ No newline at end of file
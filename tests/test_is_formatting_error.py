@@ -0,0 +1,37 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:TEST")
+os.environ.setdefault("RENDER_EXTERNAL_URL", "http://127.0.0.1")
+os.environ.setdefault("STATE_DB_FILE", os.path.join(tempfile.mkdtemp(prefix="solexa-test-"), "state.db"))
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telegram.error import BadRequest, Forbidden, RetryAfter  # noqa: E402
+
+from solexacloud import is_formatting_error  # noqa: E402
+
+@pytest.mark.parametrize("message", [
+    "Can't parse entities: can't find end of bold entity at byte offset 5",
+    "Wrong HTTP URL specified",
+    "Entity beginning at UTF-16 offset 3 must not contain the end of another entity",
+    "Bad Request: entity text is too long",
+])
+def test_formatting_errors(message):
+    assert is_formatting_error(BadRequest(message))
+
+@pytest.mark.parametrize("message", [
+    "Wrong file identifier/HTTP URL specified",
+    "Failed to get HTTP URL content",
+    "Chat not found",
+    "Message to reply not found",
+])
+def test_other_bad_requests(message):
+    assert not is_formatting_error(BadRequest(message))
+
+def test_non_bad_request_errors():
+    assert not is_formatting_error(Forbidden("Can't parse entities"))
+    assert not is_formatting_error(RetryAfter(5))